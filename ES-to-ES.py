@@ -10,12 +10,20 @@ from math import floor
 import json
 import sys
 import os
+import threading
 
 from time import sleep
 
-# for curl connection errors
-class BadConnection(Exception):
-    pass
+import es_copy_pool
+import es_reindex
+import es_repair
+import es_manifest
+import es_inventory
+import es_bulkload
+import es_stream_copy
+import es_dump
+import es_archive
+from es_http import es_run, close_pool
 
 
 line_re = re.compile(
@@ -56,123 +64,209 @@ def close_ssh_tunnel(args, control_path, host):
 # end close_ssh_tunnel
 
 
-def curl_run(args, cmd_str, ctext=False):
-    if args.verbose :
-        print("curl_run: ", cmd_str)
-
-    try:
-        run_ret = run(args=cmd_str, check=True, stdout=PIPE, stderr=PIPE, 
-                      universal_newlines=True)
-    except CalledProcessError as cpe:
-        print("Error: curl_run: unable to connect with curl!")
-        print("   command: ", cmd_str)
-        print("  response: %d\n  %s\n  %s" %
-              (cpe.returncode, cpe.stdout, cpe.stderr))
-        raise BadConnection()
-
-    if args.verbose :
-        print("  response: %s : %s" %
-              (run_ret.stdout, run_ret.stderr))
-
-    return run_ret
-
-# end curl_run
-
-
 def curl_delete_to(args, to_index):
-    cmd_del_to  = ("curl", "-X", "DELETE", "http://localhost:9200/%s/" %
-                   ( to_index ))
-    
-    curl_delete_to = curl_run(args, cmd_del_to)
+    es_run(args, "DELETE", "http://localhost:9200/%s/" % ( to_index ))
 
 # end curl_delete_to
 
 
 def curl_copy(args, from_index, to_index):
-    if args.num : args.num = args.num - 1 
     # prepare the TO index
     # create index
-    cmd_create =  ("curl", "-X", "PUT",
-                   "http://localhost:9200/%s" % ( to_index ))
-    
     # Not checking resposne, Errors should be caught during copy
-    curl_run(args, cmd_create)
+    es_run(args, "PUT", "http://localhost:9200/%s" % ( to_index ))
     
     # change total_fields limit from ES default 1000 to TPOT s/w's 2000
-    cmd_add = ("curl", "-X", "PUT", 
-               "http://localhost:9200/%s/_settings" % ( to_index ),
-               "-H", "Content-Type: application/json", "-d",
-               "{ \"index.mapping.total_fields.limit\": 2000 }")
-
     # Not checking response, Errors should be caught during copy
-    curl_run(args, cmd_add)
+    es_run(args, "PUT", "http://localhost:9200/%s/_settings" % ( to_index ),
+           { "index.mapping.total_fields.limit": 2000 })
     
-    cmd = ("curl", "-X", "POST", "http://localhost:9200/_reindex?pretty", "-H", "Content-Type: application/json", "-d", "{ \"source\": { \"remote\": { \"host\": \"http://localhost:%d\" }, \"index\": \"%s\", \"query\": { \"match_all\": {} } }, \"dest\": { \"index\": \"%s\" } }" % ( args.lport, from_index, to_index ) )
+    saved = es_bulkload.prepare(args, to_index)
+
+    try:
+        created = curl_reindex(args, from_index, to_index)
+    except Exception:
+        # put the index settings back even though the copy stopped
+        es_bulkload.finish(args, from_index, to_index, saved, False)
+        raise
+
+    es_bulkload.finish(args, from_index, to_index, saved, True)
+
+    return created
     
-    curl_copy_run = curl_run(args, cmd)
+# end curl_copy
+
+
+def curl_reindex(args, from_index, to_index):
+    if args.copier == "stream" :
+        return es_stream_copy.stream_copy(args, from_index, to_index)
 
-    curl_copy_d = json.loads(curl_copy_run.stdout)
+    if args.async_reindex :
+        return es_reindex.reindex_async(args, from_index, to_index)
 
+    curl_copy_d = es_run(args, "POST", "http://localhost:9200/_reindex",
+                         { "source": { "remote": { "host": "http://localhost:%d" % ( args.lport ) },
+                                       "index": from_index,
+                                       "query": { "match_all": {} } },
+                           "dest": { "index": to_index } })
+
+    created = 0
     if ( not "created" in curl_copy_d) :
-        print("Error: curl_copy: copy failed:\n  %s" % (curl_copy_run.stdout))
+        print("Error: curl_copy: copy failed:\n  %s" % (json.dumps(curl_copy_d)))
     else :
-        print("    Documents Created: %d" % (curl_copy_d["created"]))
+        created = curl_copy_d["created"]
+        print("    Documents Created: %d" % (created))
 
     if ( ( "failures" in curl_copy_d ) and 
          ( len(curl_copy_d["failures"]) > 0 ) )  :
         print("    Failures found: %d" % ( len(curl_copy_d["failures"]) ))
         for fail in curl_copy_d["failures"] :
             print(fail)
-    
-# end curl_copy
-
 
-def curl_check_copy(args, from_index, to_index):
-    cmd_to   = ("curl", "-X", "GET", "http://localhost:9200/%s/_count" %
-                ( to_index ) )
-    
-    cmd_from = ("curl", "-X", "GET", "http://localhost:%d/%s/_count" %
-                ( args.lport, from_index ) )
+    return created
     
-    run_to   = curl_run(args, cmd_to)
-    run_from = curl_run(args, cmd_from)
-
-    run_to_d   = json.loads(run_to.stdout)
-    run_from_d = json.loads(run_from.stdout)
+# end curl_reindex
+
+
+def curl_check_copy(args, from_index, to_index, from_inv=None, to_inv=None):
+    if from_inv is not None :
+        run_from_d = es_inventory.count_d(from_inv, from_index)
+        run_to_d   = es_inventory.count_d(to_inv, to_index)
+
+    # _cat counts nested documents too and can lag a refresh, so a
+    # mismatch is confirmed with _count before acting on it
+    if ( from_inv is None or
+         ( "count" in run_from_d and "count" in run_to_d and
+           run_from_d["count"] != run_to_d["count"] ) ) :
+        run_to_d   = es_run(args, "GET", "http://localhost:9200/%s/_count" %
+                            ( to_index ))
+        run_from_d = es_run(args, "GET", "http://localhost:%d/%s/_count" %
+                            ( args.lport, from_index ))
         
     if ( not "count" in run_from_d ) :
         print("  Index Not Found: Skipping: \'%s\'\n" %
               (from_index))
+        return ("missing", 0, 0)
     elif ( not "count" in run_to_d ) :
+        if not reserve_attempt() :
+            return ("skipped", 0, run_from_d["count"])
         print("  Copying:  %s:%d" %  (from_index, run_from_d["count"]))
-        curl_copy(args, from_index, to_index)
+        return ("copied", curl_copy(args, from_index, to_index),
+                run_from_d["count"])
     elif ( run_from_d["count"] == run_to_d["count"] ) :
         print("  Exists already: Skipping: %d == %s:%d" %
               (run_from_d["count"], to_index, run_to_d["count"]))
+        return ("exists", 0, run_from_d["count"])
     elif ( run_from_d["count"] > run_to_d["count"] ) :
+        if not reserve_attempt() :
+            return ("skipped", 0, run_from_d["count"])
+        if args.repair :
+            repaired = es_repair.repair_copy(args, from_index, to_index,
+                                             run_from_d["count"])
+            if repaired is not None :
+                return ("repaired", repaired, run_from_d["count"])
         print("  Deleting and Copying: document sizes do not match:")
         print("    %s:%d > %s:%d" %
               (from_index, run_from_d["count"],
                to_index, run_to_d["count"]))
         curl_delete_to(args, to_index)
-        curl_copy(args, from_index, to_index)
+        return ("recopied", curl_copy(args, from_index, to_index),
+                run_from_d["count"])
     else :
         print("ERROR: nuts!, should not happen: %s:%d < %s:%d" %
               (from_index, run_from_d["count"],
                to_index,   run_to_d["count"]))
+        return ("error", 0, run_from_d["count"])
 
 # end curl_check_copy
 
 
-def curl_get_indices(args):
-    cmd_ind_ls   = ("curl", "-X", "GET",
-                    "http://localhost:%d/_cat/indices/" % ( args.lport) )
-#                    "http://localhost:%d/_cat/indices/" % ( 9200 ) )
-    
-    run_ind_ls  = curl_run(args, cmd_ind_ls, ctext=True)
+# --num is shared by every host and index worker
+attempts_lock = threading.Lock()
+
+def reserve_attempt():
+    # takes one of the --num copies before starting it, so workers running
+    # at the same time can't go over; False once they are all taken
+    with attempts_lock:
+        if not counting :
+            return True
+        if attempts["left"] <= 0 :
+            print("  Reached maximum attempts set: Skipping")
+            return False
+        attempts["left"] = attempts["left"] - 1
+        return True
+
+# end reserve_attempt
+
+
+def attempts_used_up():
+    with attempts_lock:
+        if counting and attempts["left"] <= 0 :
+            return True
+    return False
+
+# end attempts_used_up
+
+
+def check_copy_counted(args, from_index, to_index, from_inv=None, to_inv=None):
+    result = curl_check_copy(args, from_index, to_index, from_inv, to_inv)
+    if counting :
+        with attempts_lock:
+            if attempts["left"] <= 0 :
+                print("\nReached maximum attempts set\n")
+            else :
+                print("%d attempts left" % (attempts["left"]))
+    return result
+
+# end check_copy_counted
+
+
+def copy_host(args, host, stats):
+    ssh_ctrl_path = "/tmp/%s:%d:%%p" % (host, floor(random.random()*999999))
+
+    if not open_ssh_tunnel(args, ssh_ctrl_path, host) :
+        stats.error = "ssh tunnel failed"
+        return
+
+    try:
+        from_inv = es_inventory.get_inventory(args, "http://localhost:%d" %
+                                              ( args.lport ))
+        index_list = curl_get_indices(args, from_inv)
+
+        if args.list :
+            print("\nIndexes:\n")
+            print(index_list)
+            return
+
+        pairs = []
+        for index in index_list :
+            from_index = index
+            if args.prefix :
+                to_index =  "%s-%s" % (args.prefix, index)
+            else :
+                to_index = "%s-%s" % (host, index)
+            pairs.append((from_index, to_index))
+
+        to_inv = es_inventory.get_inventory(args, "http://localhost:9200")
+        check_copy = lambda a, f, t: check_copy_counted(a, f, t,
+                                                        from_inv, to_inv)
 
-    index_list = [ re.sub(r'^\s*\w+\s+\w+\s+(\S+)\s.*$', r'\g<1>' , li) 
-                   for li in run_ind_ls.stdout.splitlines() ]
+        es_copy_pool.copy_indices(args, host, pairs, check_copy,
+                                  stats, should_stop=attempts_used_up)
+
+    finally:
+        close_pool("localhost", args.lport)
+        close_ssh_tunnel(args, ssh_ctrl_path, host)
+
+# end copy_host
+
+
+def curl_get_indices(args, inventory=None):
+    if inventory is None :
+        inventory = es_inventory.get_inventory(args, "http://localhost:%d" %
+                                               ( args.lport ))
+
+    index_list = list(inventory.keys())
 
     if args.exclude_override :
         ex_str = "^(users|\.)"
@@ -293,9 +387,17 @@ clparse.add_argument('--exclude_override', '-E', action='store_true',
 clparse.add_argument('--defaults', '-D', action='store_true', default=False,
                      help='show default command line values')
 clparse.add_argument('--dump', '-d', action='store_true', default=False,
-                     help='Dump indexes to file using elasticdump. Pulls from localhost!')
+                     help='Dump indexes to files (see --dumper). Pulls from localhost!')
 clparse.add_argument('--dump_dir', default="./",
                      help='Dump indexes to this directory (./)')
+es_copy_pool.add_pool_args(clparse)
+es_reindex.add_reindex_args(clparse)
+es_repair.add_repair_args(clparse)
+es_manifest.add_manifest_args(clparse)
+es_bulkload.add_bulkload_args(clparse)
+es_stream_copy.add_stream_args(clparse)
+es_dump.add_dump_args(clparse)
+es_archive.add_archive_args(clparse)
 
 args=clparse.parse_args()
 
@@ -306,6 +408,7 @@ if args.defaults :
 
 counting = False    
 if args.num > 0 : counting = True
+attempts = { "left": args.num }
 
 
 if args.dump :
@@ -318,7 +421,12 @@ if args.dump :
         sys.exit(1);
 
     print("\nDumping to '%s':\n" % (args.dump_dir) )
-    elasticdump(args, index_list)
+    if args.dumper == "elasticdump" :
+        elasticdump(args, index_list)
+    elif args.dumper in ("parquet", "arrow") :
+        es_archive.archive_indices(args, index_list)
+    else :
+        es_dump.dump_indices(args, index_list)
     
     sys.exit(1);
 
@@ -330,49 +438,4 @@ if args.hosts :
     
 # start work
 
-for host in hosts_list :
-    print("\nConnecting to: %s" % str(host))  # separate tpot output
-    
-    ssh_ctrl_path = "/tmp/%s:%d:%%p" % (host, floor(random.random()*999999))
-
-    try:
-        if not open_ssh_tunnel(args, ssh_ctrl_path, host) :
-            continue
-
-        index_list = curl_get_indices(args)
-
-        if args.list :
-            print("\nIndexes:\n")
-            print(index_list)
-            continue
-
-        for index in index_list :
-            from_index = index
-            if args.prefix :
-                to_index =  "%s-%s" % (args.prefix, index)
-            else :
-                to_index = "%s-%s" % (host, index)
-
-            print("%s: %s  to localhost: %s" % ( host, from_index, to_index ) )
-            sys.stdout.flush()
-
-            try:
-                curl_check_copy(args, from_index, to_index)
-                if counting :
-                    if args.num <= 0 :
-                        print("\nReached maximum attempts set\n")
-                        break
-                    else :
-                        print("%d attempts left" % (args.num))
-                        
-            except BadConnection:
-                print("\nError: failed to connect to %s" % (host))
-                print("         skipping the rest of coyping for %s\n" % (host))
-                break
-            
-        close_ssh_tunnel(args, ssh_ctrl_path, host)
-
-    except Exception as e:
-        close_ssh_tunnel(args, ssh_ctrl_path, host)
-        raise e
-
+es_copy_pool.run_hosts(args, hosts_list, copy_host, summary=not args.list)
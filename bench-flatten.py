@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+#
+# Benchmark for the es-to-fsdb.py record flattening
+#
+# Builds geoip-heavy Suricata style documents, flattens them with the
+# old str() / ast.literal_eval round trip and with es_flatten.fsdb_record,
+# checks both give the same columns and text, and prints the speedup.
+#
+
+import argparse
+import sys
+import ast
+import random
+from time import time
+from collections.abc import MutableMapping
+
+import es_flatten
+
+
+# The flattening es-to-fsdb.py did before es_flatten.fsdb_record
+def convert_flatten(d, parent_key ='', sep ='_'):
+    items = []
+    for k, v in d.items():
+        new_key = parent_key + sep + k if parent_key else k
+        if isinstance(v, MutableMapping):
+            items.extend(convert_flatten(v, new_key, sep = sep).items())
+        else:
+            items.append((new_key, v))
+    return dict(items)
+
+def old_record(dstruct, flatten):
+    rec = {}
+    for k in dstruct.keys():
+        fval = str(dstruct[k]).strip().replace('\n', ' ').replace('\r', '').replace('\\n', ' ')
+        if flatten:
+            try:
+                dval = ast.literal_eval(fval)
+                dval = convert_flatten(dval)
+                for fk in dval.keys():
+                    rec[k+"_"+fk] = str(dval[fk])
+            except:
+                rec[k] = fval
+        else:
+            rec[k] = fval
+    return rec
+
+
+def make_doc(i):
+    ip = "%d.%d.%d.%d" % (random.randint(1, 223), random.randint(0, 255),
+                          random.randint(0, 255), random.randint(1, 254))
+    return {
+        "@timestamp": "2021-05-01T%02d:%02d:%02d.%03dZ" % (i // 3600 % 24, i // 60 % 60, i % 60, i % 1000),
+        "event_type": random.choice(["alert", "flow", "http", "dns"]),
+        "src_ip": ip, "src_port": random.randint(1024, 65535),
+        "dest_ip": "10.0.0.%d" % (i % 250), "dest_port": random.choice([22, 23, 80, 443]),
+        "proto": "TCP", "flow_id": random.randint(0, 2**50),
+        "geoip": { "ip": ip, "country_name": "Some Country", "country_code2": "SC",
+                   "continent_code": "EU", "city_name": "City %d" % (i % 97),
+                   "latitude": random.uniform(-90, 90), "longitude": random.uniform(-180, 180),
+                   "location": { "lat": random.uniform(-90, 90), "lon": random.uniform(-180, 180) },
+                   "timezone": "Europe/Somewhere", "asn": random.randint(1, 65000),
+                   "as_org": "Some \"ISP\" Ltd" },
+        "alert": { "signature": "ET SCAN line\nbreak %d" % (i % 13), "signature_id": 2000000 + i % 500,
+                   "severity": i % 3 + 1, "metadata": { "tags": ["scan", "tpot"], "flag": None } },
+        "http": { "hostname": "host%d.example" % (i % 50), "url": "/a\\nb/%d" % (i),
+                  "http_user_agent": "Mozilla/5.0 (X11)", "status": 200, "empty": {} },
+        "tags": ["suricata", "tpot"], "host": "tpot%d" % (i % 4), "type": "Suricata",
+        "payload_printable": "GET / HTTP/1.1\r\nHost: x\r\n\r\n" if i % 5 == 0 else "",
+        "note": "{'looks': {'like': 'a dict'}}" if i % 50 == 0 else "  padded  ",
+        "ok": i % 2 == 0, "score": 0.5 * i, "nothing": None,
+    }
+
+
+def main(argv):
+    p = argparse.ArgumentParser()
+    p.add_argument("-n", "--docs", help="Number of documents (default=20000)", default=20000, type=int)
+    p.add_argument("-B", "--noflatten", help="Benchmark without --flatten", action="store_true")
+    parg = p.parse_args(argv)
+
+    random.seed(1)
+    docs = [make_doc(i) for i in range(parg.docs)]
+    flatten = not parg.noflatten
+
+    start = time()
+    old = [old_record(d, flatten) for d in docs]
+    old_secs = time() - start
+
+    start = time()
+    new = [es_flatten.fsdb_record(d, flatten) for d in docs]
+    new_secs = time() - start
+
+    bad = sum(1 for (a, b) in zip(old, new) if a != b)
+    if bad:
+        print("Error: %d of %d records differ" % (bad, len(docs)))
+        for (a, b) in zip(old, new):
+            if a != b:
+                print("  old: %s\n  new: %s" % (a, b))
+                break
+        exit(1)
+
+    print("%d docs, %d columns, flatten=%s" % (len(docs), len(new[0]), flatten))
+    print("  literal_eval: %7.2f s  %9.0f docs/s" % (old_secs, len(docs) / old_secs))
+    print("  fsdb_record:  %7.2f s  %9.0f docs/s" % (new_secs, len(docs) / new_secs))
+    print("  speedup:      %7.1fx" % (old_secs / new_secs))
+    exit(0)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -10,17 +10,34 @@
 
 import argparse
 import sys
+import os
 from elasticsearch import Elasticsearch
 import json
-from collections import defaultdict, MutableMapping
 import pandas as pd
-import json
-import ast
 import dateutil.parser
 import datetime
+import time
+import heapq
+import fnmatch
+import itertools
+import threading
+from queue import Queue, Empty
+import es_flatten
+import es_daterange
+import es_cache
+import es_sink
 
 SCROLL_WAIT = '30s'
+PIT_WAIT = '1m'
 SCROLL_SIZE = 10000
+SLICE_QUEUE = 2     # scroll pages each slice can read ahead of the writer
+STREAM_CHUNK = 10000    # rows whose times --stream converts at once
+FLATTEN_PATHS = 6   # most "_"s in a -F field to try as object levels
+AGG_SIZE = 1000     # composite aggregation buckets per page
+AGG_METRICS = ["count", "min", "max", "avg", "sum", "cardinality"]
+CALENDAR = ["1m", "1h", "1d", "1w", "1M", "1q", "1y"]
+# the parts of a search or scroll response that are read
+FILTER_PATH = "_scroll_id,pit_id,hits.hits._id,hits.hits._source,hits.hits.sort"
 
 def name_value(s):
     usagestr = "name:value"
@@ -34,6 +51,16 @@ def name_value(s):
     except:
         raise argparse.ArgumentTypeError(usagestr)
 
+def metric_spec(s):
+    # func:field, count:field counts the documents that have field
+    try:
+        func, field = s.split(':', 1)
+        if func not in AGG_METRICS or not field:
+            raise Exception('Option error')
+        return { "name":func, "value":field }
+    except:
+        raise argparse.ArgumentTypeError("func:field, func one of %s" % (",".join(AGG_METRICS)))
+
 def construct_condition_str(paramlist):
     outstr = ""
     sep =""
@@ -54,17 +81,6 @@ def construct_date_str(paramlist):
             outstr += '%s "%s":"%s"' % (sep, m["name"], m["value"])
     return outstr
 
-# https://www.geeksforgeeks.org/python-convert-nested-dictionary-into-flattened-dictionary/
-def convert_flatten(d, parent_key ='', sep ='_'):
-    items = []
-    for k, v in d.items():
-        new_key = parent_key + sep + k if parent_key else k
-        if isinstance(v, MutableMapping):
-            items.extend(convert_flatten(v, new_key, sep = sep).items())
-        else:
-            items.append((new_key, v))
-    return dict(items)
-
 def parse_date_if_possible(x):
     dt = x
     if dt.isnumeric():
@@ -78,7 +94,84 @@ def parse_date_if_possible(x):
     except:
         return dt
 
-def do_extract(parg):
+EPOCH_NUM = r'^[0-9]{1,18}$'
+ISO_TIME = r'^(\d{4}-\d{2}-\d{2}(?:[T ]\d{2}:\d{2}(?::\d{2}(?:\.\d+)?)?)?)(Z|[+-]\d{2}(?::?\d{2})?)?$'
+ISO_FORMAT = {'format': 'ISO8601'} if int(pd.__version__.split('.')[0]) >= 2 else {}
+
+def offset_of(secs, sample):
+    # How far parse_date_if_possible moves each time in secs (seconds,
+    # read as UTC), worked out on the strings sample(s) gives for the
+    # start and end of each hour, or of each minute in an hour where the
+    # local offset changes.  NaN where it could not be worked out.
+    known = {}
+    def offset(s):
+        if s not in known:
+            try:
+                known[s] = int(parse_date_if_possible(sample(s))) - s
+            except (ValueError, TypeError, OverflowError, OSError):
+                known[s] = None
+        return known[s]
+
+    hours = secs // 3600
+    by_hour = {}
+    for h in hours.unique():
+        first = offset(h * 3600)
+        by_hour[h] = first if first == offset(h * 3600 + 3540) else None
+    offsets = hours.map(by_hour)
+
+    split = offsets.isna()
+    if split.any():
+        mins = secs[split] // 60
+        offsets[split] = mins.map({ m: offset(m * 60) for m in mins.unique() })
+    return offsets
+
+def fill_epoch(out, secs, sample):
+    offsets = offset_of(secs, sample)
+    ok = offsets.notna()
+    out[secs[ok].index] = (secs[ok] + offsets[ok]).astype('int64').astype(str)
+
+def epoch_seconds(col):
+    # parse_date_if_possible for a whole column of time strings.  Epoch
+    # seconds and millis and ISO-8601 times are converted together, with
+    # the local time offset looked up once per hour; values that are
+    # neither are parsed one at a time as before.
+    out = pd.Series(None, index=col.index, dtype=object)
+
+    num = col.str.match(EPOCH_NUM).fillna(False).astype(bool)
+    if num.any():
+        v = col[num].astype('int64')
+        secs = v.where(col[num].str.len() <= 12, v // 1000)
+        fill_epoch(out, secs, lambda s: str(s))
+
+    parts = col[~num].str.extract(ISO_TIME)
+    if parts[0].notna().any():
+        wall = pd.to_datetime(parts[0], errors='coerce', **ISO_FORMAT)
+        wall = wall[wall.notna()]
+        secs = (wall - pd.Timestamp(0)) // pd.Timedelta(seconds=1)
+        # strftime('%s') reads a time with an offset as local standard
+        # time, and one without as local time
+        aware = parts[1][wall.index].notna()
+        fill_epoch(out, secs[~aware], lambda s: time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(s)))
+        fill_epoch(out, secs[aware], lambda s: time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(s)))
+
+    rest = out.isna()
+    out[rest] = col[rest].apply(lambda x: parse_date_if_possible(x))
+    return out
+
+def utc_seconds(col):
+    # Epoch seconds of each time string in UTC, unlike epoch_seconds
+    # with no local offset, NaN where it can't be read
+    secs = pd.Series(float('nan'), index=col.index)
+    num = col.str.match(EPOCH_NUM).fillna(False).astype(bool)
+    if num.any():
+        v = col[num].astype('int64')
+        secs[num] = v.where(col[num].str.len() <= 12, v // 1000)
+    if (~num).any():
+        t = pd.to_datetime(col[~num], utc=True, errors='coerce', **ISO_FORMAT)
+        secs[~num] = (t - pd.Timestamp(0, tz='UTC')) // pd.Timedelta(seconds=1)
+    return secs
+
+def build_query(parg):
 
     # Construct various conditional prases
     muststr = construct_condition_str(parg.must)
@@ -100,7 +193,9 @@ def do_extract(parg):
     querystr_template = '{"query":{"bool":{"must":[%s],"must_not":[%s],"should":[%s]}}}'
     querystr = querystr_template % (muststr, mustnotstr, shouldstr)
     #print(querystr, parg.index)
+    return querystr
 
+def connect(parg):
     urlpfxstr = ""
     if parg.urlpfx:
         urlpfxstr = "es"
@@ -108,97 +203,476 @@ def do_extract(parg):
     if parg.insecure:
         es = Elasticsearch([{'host': parg.eshost, 'port': parg.esport,
                             'url_prefix': urlpfxstr, 'use_ssl': True}],
-                            use_ssl=True, verify_certs=False,
+                            use_ssl=True, verify_certs=False, http_compress=True,
                             timeout=30, max_retries=10, retry_on_timeout=True)
     else:
         es = Elasticsearch([{'host': parg.eshost, 'port': parg.esport,
-                            'url_prefix': urlpfxstr}], timeout=30,
+                            'url_prefix': urlpfxstr}], timeout=30, http_compress=True,
                             max_retries=10, retry_on_timeout=True)
+    return es
+
+def pick_index(es, parg):
+    # With a date range and the default _all, query only the daily
+    # indexes the range covers that exist.  Ranges that are open on both
+    # ends or can't be read, and clusters without daily indexes, keep
+    # the index as given.
+    if parg.index != "_all" or not parg.daterange or not parg.daily:
+        return parg.index
+    bounds = { m["name"]: m["value"] for m in parg.daterange }
+    indexes = es_daterange.prune_indices(es, parg.daily, bounds)
+    if indexes is None:
+        return parg.index
+    if not indexes:
+        print("WARNING: no %s indexes in the date range" % (parg.daily), file=sys.stderr)
+    return ",".join(indexes)
+
+def field_paths(field, flatten):
+    # The _source paths a -F column can come from: the field itself and,
+    # with --flatten, each way its "_"s can be object levels
+    parts = field.split("_")
+    if not flatten or len(parts) == 1:
+        return [field]
+    if len(parts) - 1 > FLATTEN_PATHS:
+        return [parts[0] + "*"]
+    paths = []
+    for seps in itertools.product(["_", "."], repeat=len(parts) - 1):
+        paths.append(parts[0] + "".join(sp + pt for (sp, pt) in zip(seps, parts[1:])))
+    return paths
+
+def source_filter(parg):
+    # _source includes and excludes, so the cluster only sends the fields
+    # that will be written
+    if parg.fields:
+        includes = []
+        for f in parg.fields:
+            includes.extend(field_paths(f, parg.flatten))
+    else:
+        includes = parg.include or []
+    src = {}
+    if includes:
+        src["includes"] = list(dict.fromkeys(includes))
+    if parg.exclude:
+        src["excludes"] = parg.exclude
+    return src
+
+def path_wanted(path, parg):
+    # Whether --include and --exclude keep a field, matched like ES does
+    def match(p):
+        return fnmatch.fnmatchcase(path, p) or fnmatch.fnmatchcase(path, p + ".*")
+    if parg.include and not any(match(p) for p in parg.include):
+        return False
+    if parg.exclude and any(match(p) for p in parg.exclude):
+        return False
+    return True
+
+def search_body(parg):
+    body = json.loads(build_query(parg))
+    src = source_filter(parg)
+    if src:
+        body["_source"] = src
+    return body
+
+def do_extract(parg, since=None):
+
+    body = search_body(parg)
+    if since is not None:
+        # only what is new since the cached rows
+        body["query"]["bool"]["must"].append(
+            { "range": { parg.timecol: { "gte": int(since), "format": "epoch_second" } } })
+    es = connect(parg)
+    parg.index = pick_index(es, parg)
+    if not parg.index:
+        return []
 
     # Do the actual query
-    results = None
-    res = es.search(index=parg.index, size=SCROLL_SIZE, body=querystr, request_timeout=30, scroll = SCROLL_WAIT)
-    if res:
-        results = []
-        old_scroll_id = res['_scroll_id']
-        while len(res['hits']['hits']):
-            new_res = [d for d in res['hits']['hits']]
-            results.extend(new_res)
+    if parg.slices > 1:
+        hits = sliced_hits(es, parg, body, False)
+    else:
+        hits = page_hits(scroll_pages(es, parg, body))
+    results = []
+    try:
+        for d in hits:
+            results.append(d)
             if(parg.size > 0 and len(results) >= parg.size):
-                results = results[:parg.size]
                 break
+    finally:
+        hits.close()
+
+    return results
+
+def get_columns(es, parg):
+    # Output columns, known before the first hit: the -F fields, or the
+    # fields of every matching index's mapping, named like flatten_record
+    if parg.fields:
+        cols = list(dict.fromkeys(parg.fields))
+    else:
+        mapping = es.indices.get_mapping(index=parg.index)
+        cols = []
+        for index in mapping.keys():
+            props = es_flatten.index_properties(mapping, index)
+            cols.extend(es_flatten.record_columns(props, parg.flatten,
+                                                  lambda path: path_wanted(path, parg)))
+        cols = list(dict.fromkeys(cols))
+    # Move timestamp to the first column
+    if parg.timecol in cols:
+        cols.remove(parg.timecol)
+        cols.insert(0, parg.timecol)
+    return cols
+
+def scroll_pages(es, parg, body):
+    # Yields one scroll page of hits at a time, clearing the scroll after
+    res = es.search(index=parg.index, size=SCROLL_SIZE, body=body, request_timeout=30, scroll = SCROLL_WAIT, filter_path = FILTER_PATH)
+    scroll_id = res.get('_scroll_id')
+    try:
+        # filter_path leaves out "hits" when there are none
+        while len(res.get('hits', {}).get('hits', [])):
+            yield res['hits']['hits']
             res = es.scroll(
-                scroll_id = old_scroll_id,
-                scroll = SCROLL_WAIT
+                scroll_id = scroll_id,
+                scroll = SCROLL_WAIT,
+                filter_path = FILTER_PATH
             )
-            old_scroll_id = res['_scroll_id']
+            scroll_id = res.get('_scroll_id', scroll_id)
+    finally:
+        if scroll_id:
+            try:
+                es.clear_scroll(scroll_id = scroll_id)
+            except Exception:
+                pass
 
-    return results
-    
-def write_to_fsdb(outfile, data, fields, addheader, flatten, timecol):
+def pit_pages(es, parg, body, pit_id=None):
+    # Yields pages from a point in time with search_after, in the order
+    # of body's sort, then closes the point in time unless it was given
+    opened = pit_id is None
+    if opened:
+        pit_id = es.open_point_in_time(index=parg.index, keep_alive=PIT_WAIT)["id"]
+    body = dict(body)
+    # _shard_doc breaks ties, so search_after never skips or repeats a hit
+    body["sort"] = body.get("sort", []) + [{ "_shard_doc": "asc" }]
+    body["size"] = SCROLL_SIZE
+    try:
+        while True:
+            body["pit"] = { "id": pit_id, "keep_alive": PIT_WAIT }
+            res = es.search(body=body, request_timeout=30, filter_path=FILTER_PATH)
+            pit_id = res.get("pit_id", pit_id)
+            hits = res.get('hits', {}).get('hits', [])
+            if not len(hits):
+                break
+            yield hits
+            body["search_after"] = hits[-1]["sort"]
+    finally:
+        if opened:
+            try:
+                es.close_point_in_time(body={ "id": pit_id })
+            except Exception:
+                pass
+
+def page_hits(pages):
+    try:
+        for hits in pages:
+            yield from hits
+    finally:
+        pages.close()
 
-    vals = defaultdict(list)
+def slice_worker(es, parg, body, slice_id, q, halt, pit_id):
+    sbody = dict(body)
+    sbody["slice"] = { "id": slice_id, "max": parg.slices }
+    if pit_id:
+        pages = pit_pages(es, parg, sbody, pit_id)
+    else:
+        pages = scroll_pages(es, parg, sbody)
+    try:
+        for hits in pages:
+            if halt.is_set():
+                break
+            q.put(hits)
+    except Exception as e:
+        q.put(e)
+    finally:
+        pages.close()
+        q.put(None)
 
-    #df = pd.DataFrame()
+def queue_hits(q, workers):
+    # Hits from q until each of its workers has finished
+    done = 0
+    while done < workers:
+        item = q.get()
+        if item is None:
+            done += 1
+        elif isinstance(item, Exception):
+            raise item
+        else:
+            yield from item
 
-    print("Flattening Results")
+def sliced_hits(es, parg, body, ordered):
+    # Reads parg.slices scroll slices at once, one thread each.  Ordered
+    # slices (body sorted on timecol) are merged back into time order,
+    # otherwise pages are passed on as they arrive.
+    halt = threading.Event()
+    # The slices of a point in time all read the same one
+    pit_id = None
+    if parg.pit:
+        pit_id = es.open_point_in_time(index=parg.index, keep_alive=PIT_WAIT)["id"]
+    if ordered:
+        queues = [Queue(maxsize=SLICE_QUEUE) for i in range(parg.slices)]
+    else:
+        queues = [Queue(maxsize=SLICE_QUEUE * parg.slices)] * parg.slices
+    threads = [threading.Thread(target=slice_worker, daemon=True,
+                                args=(es, parg, body, i, queues[i], halt, pit_id))
+               for i in range(parg.slices)]
+    for t in threads:
+        t.start()
+
+    try:
+        if ordered:
+            yield from heapq.merge(*[queue_hits(q, 1) for q in queues],
+                                   key=lambda d: d["sort"][0])
+        else:
+            yield from queue_hits(queues[0], parg.slices)
+    finally:
+        # Stopped early, unblock the workers so they clear their scrolls
+        halt.set()
+        while any(t.is_alive() for t in threads):
+            for q in set(queues):
+                try:
+                    q.get(timeout=0.1)
+                except Empty:
+                    pass
+        for t in threads:
+            t.join()
+        if pit_id:
+            try:
+                es.close_point_in_time(body={ "id": pit_id })
+            except Exception:
+                pass
+
+def agg_column(field):
+    return field.replace(".keyword", "").replace(".", "_")
+
+def agg_body(parg):
+    # A composite aggregation with a source per -g field, terms or a
+    # date_histogram for field:interval, and a sub-aggregation per -m
+    body = json.loads(build_query(parg))
+    body["size"] = 0
+    sources = []
+    fields = [g.partition(":")[0] for g in parg.groupby]
+    names = set()
+    for g in parg.groupby:
+        field, _, interval = g.partition(":")
+        name = agg_column(field)
+        if interval:
+            unit = "calendar_interval" if interval in CALENDAR else "fixed_interval"
+            src = { "date_histogram": { "field": field, unit: interval } }
+            # a field grouped at more than one interval gets a column each
+            if fields.count(field) > 1:
+                name += "_" + interval
+        else:
+            src = { "terms": { "field": field, "missing_bucket": True } }
+        name = es_flatten.unique_key(names, name)
+        names.add(name)
+        sources.append({ name: src })
+    metrics = {}
+    for m in parg.metric or []:
+        func = "value_count" if m["name"] == "count" else m["name"]
+        metrics["%s_%s" % (m["name"], agg_column(m["value"]))] = { func: { "field": m["value"] } }
+    body["aggs"] = { "groups": { "composite": { "size": AGG_SIZE, "sources": sources } } }
+    if metrics:
+        body["aggs"]["groups"]["aggs"] = metrics
+    return body
+
+def bucket_pages(es, parg, body):
+    # Yields each page of composite buckets, following after_key
+    while True:
+        res = es.search(index=parg.index, body=body, request_timeout=60,
+                        filter_path="aggregations.groups.after_key,aggregations.groups.buckets")
+        groups = res.get("aggregations", {}).get("groups", {})
+        buckets = groups.get("buckets", [])
+        if not buckets:
+            break
+        yield buckets
+        if "after_key" not in groups:
+            break
+        body["aggs"]["groups"]["composite"]["after"] = groups["after_key"]
+
+def agg_value(v, date):
+    # Dates (histogram keys, and metrics that come with value_as_string)
+    # as the UTC time strings ES returns in documents, so agg_dates can
+    # convert them like the time column; whole numbers without ".0"
+    if v is None:
+        return ""
+    if date:
+        return time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(v // 1000))
+    if isinstance(v, float) and v.is_integer():
+        return str(int(v))
+    return str(v)
+
+def agg_dates(rows, dates):
+    # The date columns of a page of rows to epoch seconds, with the same
+    # local offset handling as the time column of documents
+    for i in dates:
+        secs = epoch_seconds(pd.Series([row[i] for row in rows], dtype=object))
+        for (row, v) in zip(rows, secs):
+            row[i] = v if isinstance(v, str) else row[i]
+
+def do_aggregate(parg):
+    es = connect(parg)
+    parg.index = pick_index(es, parg)
+    if not parg.index:
+        return False
+    body = agg_body(parg)
+    sources = [list(src.items())[0] for src in body["aggs"]["groups"]["composite"]["sources"]]
+    metrics = list(body["aggs"]["groups"].get("aggs", {}).keys())
+    cols = [name for (name, src) in sources] + ["count"] + metrics
+
+    count = 0
+    sink = open_sink(parg, cols)
+    try:
+        for buckets in bucket_pages(es, parg, body):
+            rows = []
+            dates = set(n for (n, (name, src)) in enumerate(sources)
+                        if "date_histogram" in src or src["terms"]["field"] == parg.timecol)
+            for b in buckets[:parg.size - count if parg.size > 0 else None]:
+                row = [agg_value(b["key"].get(name), n in dates)
+                       for (n, (name, src)) in enumerate(sources)]
+                row.append(str(b["doc_count"]))
+                for name in metrics:
+                    v = b.get(name, {})
+                    if "value_as_string" in v:
+                        dates.add(len(row))
+                    row.append(agg_value(v.get("value"), "value_as_string" in v))
+                rows.append(row)
+            agg_dates(rows, dates)
+            for row in rows:
+                sink.write(row)
+            count += len(rows)
+            if parg.size > 0 and count >= parg.size:
+                return sink.close()
+    except BaseException:
+        sink.close()
+        raise
+    return sink.close()
+
+def do_stream(parg):
+    es = connect(parg)
+    parg.index = pick_index(es, parg)
+    if not parg.index:
+        return False
+    cols = get_columns(es, parg)
+    if not cols:
+        print("Query to elasticsearch failed: no fields found for %s" % (parg.index))
+        return False
+
+    body = search_body(parg)
+    if parg.timecol in cols:
+        # Sorted by the cluster, so rows can be written as they arrive
+        body["sort"] = [{ parg.timecol: { "order": "asc", "missing": "_last",
+                                          "unmapped_type": "date" } }]
+    else:
+        print("WARNING: Did not find %s in header. Not transforming" % (parg.timecol), file=sys.stderr)
+
+    if parg.slices > 1:
+        hits = sliced_hits(es, parg, body, parg.timecol in cols)
+    elif parg.pit:
+        hits = page_hits(pit_pages(es, parg, body))
+    else:
+        hits = page_hits(scroll_pages(es, parg, body))
+    try:
+        sink = open_sink(parg, cols)
+        (count, ok) = stream_to_fsdb(sink, hits, cols, parg.size, parg.flatten, parg.timecol, not parg.fields)
+    finally:
+        hits.close()
+    return ok
+    
+def flatten_record(d, fields, flatten):
+    rec = es_flatten.fsdb_record(d["_source"], flatten)
+    # Delete keys that don't exist in selection list
+    if fields:
+        for k in list(rec.keys()):
+            if k not in fields:
+                del rec[k]
+    return rec
+
+def flatten_rows(data, fields, flatten, timecol):
+    # Columns get an index the first time they are seen, and each row is
+    # a list in that order
+    colidx = {}
     cols = []
-    rowdicts = []
+    rows = []
     for d in data:
-        rec = {}
         if "_source" in d.keys():
-            dstruct = d["_source"]
-            for k in dstruct.keys():
-                fval = str(dstruct[k]).strip().replace('\n', ' ').replace('\r', '').replace('\\n', ' ')
-                if flatten:
-                    try:
-                        dval = ast.literal_eval(fval)
-                        dval = convert_flatten(dval)
-                        for fk in dval.keys():
-                            rec[k+"_"+fk] = str(dval[fk])
-                    except:
-                        rec[k] = fval
-                else:
-                    rec[k] = fval
-            # Delete keys that don't exist in selection list
-            if fields:
-                for k in list(rec.keys()):
-                    if k not in fields:
-                        del rec[k]
-            rowdicts.append(rec)
-            cols.extend(list(rec.keys()))
-            cols = list(set(cols))
+            rec = flatten_record(d, fields, flatten)
+            row = [""] * len(cols)
+            for k, v in rec.items():
+                i = colidx.get(k)
+                if i is None:
+                    i = colidx[k] = len(cols)
+                    cols.append(k)
+                    row.append("")
+                row[i] = v
+            rows.append(row)
     # Move timestamp to the first column
-    if timecol in cols:
-        cols.remove(timecol)
-        cols.insert(0, timecol)
-    rows = []
-    for r in rowdicts:
-        val = []
-        for c in cols:
-            if c in r.keys():
-                val.append(r[c])
-            else:
-                val.append("")
-        rows.append(val)
+    order = list(range(len(cols)))
+    if timecol in colidx:
+        order.remove(colidx[timecol])
+        order.insert(0, colidx[timecol])
+    cols = [cols[i] for i in order]
+    rows = [[r[i] if i < len(r) else "" for i in order] for r in rows]
+    return (cols, rows)
+
+def to_frame(data, fields, flatten, timecol, cached=False):
+    # The rows as a DataFrame, with times in epoch seconds; cached rows
+    # also keep the document _id and UTC time
+    print("Flattening Results")
+    (cols, rows) = flatten_rows(data, fields, flatten, timecol)
 
     df = pd.DataFrame(rows, columns=cols)
-    headers = list(df.columns)
+    if cached:
+        df[es_cache.ID_COL] = [d.get("_id") for d in data if "_source" in d.keys()]
 
     # Transform time field
-    if timecol in headers:
-        print("Sorting Results.")
+    if timecol in cols:
         df = df.loc[df[timecol] != "0"]
+        if cached:
+            df[es_cache.TIME_COL] = utc_seconds(df[timecol])
         # ISO 8601 format date
-        df[timecol] = df[timecol].apply(lambda x: parse_date_if_possible(x))
+        df[timecol] = epoch_seconds(df[timecol])
         df = df.astype({timecol: 'int64'})
+    return df
+
+def open_sink(parg, cols):
+    if parg.output == "kafka":
+        return es_sink.KafkaSink(parg.brokers, parg.topic, cols, parg.timecol,
+                                 parg.compression, parg.batch)
+    if parg.output == "ndjson":
+        return es_sink.NdjsonSink(parg.outfile, cols, parg.timecol)
+    if parg.output == "pyfsdb":
+        return es_sink.PyfsdbSink(parg.outfile, cols)
+    return es_sink.FsdbSink(parg.outfile, cols, parg.addheader)
+
+def write_frame(outfile, df, addheader, timecol, sink=None):
+
+    headers = list(df.columns)
+
+    if timecol in headers:
+        print("Sorting Results.")
         # Sort values
-        df.sort_values(by=[timecol], inplace=True)
+        df = df.sort_values(by=[timecol], kind='stable')
     else:
         print("WARNING: Did not find %s in header. Not transforming" % (timecol))
 
 
     print("Writing results to file.")
+    if sink:
+        # sink(cols) opens a --output other than fsdb
+        out = sink(headers)
+        try:
+            for row in df.itertuples(index=False, name=None):
+                out.write([str(v) for v in row])
+        except BaseException:
+            out.close()
+            raise
+        return out.close()
+
     with outfile as fp:
         if addheader:
             #hdrstr = "#fsdb -F C|"
@@ -209,6 +683,103 @@ def write_to_fsdb(outfile, data, fields, addheader, flatten, timecol):
         #df = df.replace(r'\\r', '', regex=True)
         #df.to_csv(path_or_buf=fp, sep='|', header=False, index=False)
         df.to_csv(path_or_buf=fp, sep='\t', header=False, index=False)
+    return True
+
+def write_to_fsdb(outfile, data, fields, addheader, flatten, timecol, sink=None):
+    return write_frame(outfile, to_frame(data, fields, flatten, timecol), addheader, timecol, sink)
+
+def range_bound(parg, names, upper):
+    # Epoch seconds of a -D bound, None if it isn't given or can't be read.
+    # Never inside the range ES uses, so the cache only keeps extra rows.
+    bounds = { m["name"]: m["value"] for m in parg.daterange or [] }
+    for name in names:
+        if name in bounds:
+            t = es_daterange.parse_bound(bounds[name], upper, bounds.get("format"))
+            if t is None:
+                return None
+            if "time_zone" in bounds:
+                # naive times and rounding are in that zone, up to a day off
+                t += datetime.timedelta(days=1) if upper else -datetime.timedelta(days=1)
+            return t.timestamp()
+    return None
+
+def do_cached(parg, sink=None):
+    # Rows from an earlier run of the same query are kept, and only
+    # documents from the newest cached time on are fetched and merged in
+    key = es_cache.cache_key(search_body(parg), parg.index,
+                             [parg.fields, parg.flatten, parg.timecol, parg.daily])
+    (old, watermark) = es_cache.load_cache(parg.cache, key)
+
+    # an end before the watermark can't have anything new
+    upper = range_bound(parg, es_daterange.UPPER, True)
+    if watermark is not None and upper is not None and watermark > upper:
+        data = []
+    else:
+        data = do_extract(parg, since=watermark)
+    new = to_frame(data, parg.fields, parg.flatten, parg.timecol, cached=True)
+    df = es_cache.merge_rows(old, new)
+
+    if es_cache.TIME_COL in df.columns:
+        # rows a relative (now-...) range has moved past
+        lower = range_bound(parg, es_daterange.LOWER, False)
+        if lower is not None:
+            df = df.loc[~(df[es_cache.TIME_COL] < lower)]
+        if df[es_cache.TIME_COL].notna().any():
+            watermark = df[es_cache.TIME_COL].max()
+    else:
+        watermark = None
+
+    if not len(df):
+        print("Query to elasticsearch failed")
+        return False
+    es_cache.save_cache(parg.cache, key, df, watermark, parg.cache_size * 1024 * 1024)
+
+    df = df.drop(columns=[c for c in (es_cache.ID_COL, es_cache.TIME_COL) if c in df.columns])
+    return write_frame(parg.outfile, df, parg.addheader, parg.timecol, sink)
+
+
+def stream_to_fsdb(sink, hits, cols, size, flatten, timecol, warn=False):
+    # Writes hits to sink as they arrive, in the same format as
+    # write_to_fsdb; only the scroll pages being read and one chunk of
+    # rows are held.  The columns are fixed before the first hit, so with
+    # warn a field outside them (not in the mapping) is reported once.
+    # Returns (rows written, whether the sink took them)
+    count = 0
+    rows = []
+    known = set(cols)
+
+    def write_rows():
+        if rows and cols[0] == timecol:
+            times = epoch_seconds(pd.Series([r[0] for r in rows], dtype=object))
+            for (r, t) in zip(rows, times):
+                r[0] = t
+        for r in rows:
+            sink.write(r)
+        del rows[:]
+
+    try:
+        for d in hits:
+            if "_source" not in d.keys():
+                continue
+            rec = flatten_record(d, None, flatten)
+            if warn and not known.issuperset(rec):
+                for k in rec:
+                    if k not in known:
+                        print("WARNING: field %s is not in the index mapping, not written" % (k), file=sys.stderr)
+                        known.add(k)
+            if rec.get(timecol) == "0":
+                continue
+            rows.append([rec.get(c, "") for c in cols])
+            count += 1
+            if len(rows) >= STREAM_CHUNK:
+                write_rows()
+            if size > 0 and count >= size:
+                break
+        write_rows()
+    except BaseException:
+        sink.close()
+        raise
+    return (count, sink.close())
 
 
 def main(argv):
@@ -222,14 +793,66 @@ def main(argv):
     p.add_argument("-X", "--mustnot", help="Field that must not match (logical NOT)", action='append', type=name_value)
     p.add_argument("-S", "--should", help="Field that should match (logical OR)", action='append', type=name_value)
     p.add_argument("-D", "--daterange", help="Specifiy date range", action='append', type=name_value)
+    p.add_argument("-d", "--daily", help="With -D and the default index, query only the daily indexes named like this in the range, '' for none (default=%s)" % (es_daterange.DAILY_PATTERN.replace("%", "%%")), default=es_daterange.DAILY_PATTERN)
     p.add_argument("-F", "--fields", help="Returned fields", action="append", type=str)
+    p.add_argument("-a", "--include", help="Only fetch _source fields matching this pattern (wildcards ok, ignored with -F)", action="append", type=str)
+    p.add_argument("-x", "--exclude", help="Don't fetch _source fields matching this pattern (wildcards ok)", action="append", type=str)
     p.add_argument("-B", "--flatten", help="Flatten indexes", action="store_true")
     p.add_argument("-H", "--addheader", help="Add FSDB header", action="store_true")
     p.add_argument("-I", "--insecure", help="Don't verify certs", action="store_true")
     p.add_argument("-U", "--urlpfx", help="Use the 'es' prefix in the URL", action="store_true")
     p.add_argument("-o", "--outfile", help="Output file", type=argparse.FileType('w'), default="-")
+    p.add_argument("-n", "--slices", help="Scroll slices read in parallel (default=1)", default=1, type=int)
+    p.add_argument("-w", "--stream", help="Write rows as they arrive, sorted by the cluster, in bounded memory", action="store_true")
+    p.add_argument("-P", "--pit", help="Page with a point in time and search_after instead of a scroll (implies --stream)", action="store_true")
+    p.add_argument("-C", "--cache", help="Keep results in this directory and only fetch what is new on a repeat query (default=$ES_FSDB_CACHE)", default=os.environ.get("ES_FSDB_CACHE"))
+    p.add_argument("-z", "--cache_size", help="Most MB the cache may use (default=1024)", default=1024, type=int)
+    p.add_argument("-N", "--no-cache", help="Don't use or update the cache", dest="nocache", action="store_true")
+    p.add_argument("-O", "--output", help="Write rows as fsdb, pyfsdb (FSDB through pyfsdb), ndjson or kafka (default=fsdb)", choices=es_sink.SINKS, default="fsdb")
+    p.add_argument("-k", "--topic", help="With --output kafka, the topic to publish rows to", type=str)
+    p.add_argument("-K", "--brokers", help="With --output kafka, comma separated Kafka brokers (default=localhost:9092)", default="localhost:9092")
+    p.add_argument("-Z", "--compression", help="With --output kafka, batch compression (default=gzip)", choices=["gzip", "snappy", "lz4", "zstd", "none"], default="gzip")
+    p.add_argument("-b", "--batch", help="With --output kafka, most bytes per batch (default=524288)", default=524288, type=int)
+    p.add_argument("-g", "--groupby", help="Write one row per bucket of this field (keyword or numeric) instead of documents, field:interval (e.g. @timestamp:1d) for time buckets", action="append", type=str)
+    p.add_argument("-m", "--metric", help="With -g, add a column of func:field per bucket, func one of %s" % (",".join(AGG_METRICS)), action="append", type=metric_spec)
 
     parg = p.parse_args(argv)
+    if parg.metric and not parg.groupby:
+        p.error("--metric needs --groupby")
+    if parg.output == "kafka" and not parg.topic:
+        p.error("--output kafka needs --topic")
+    if parg.output == "kafka" and es_sink.KafkaProducer is None:
+        p.error("--output kafka needs the kafka-python module")
+    if parg.output == "pyfsdb" and es_sink.pyfsdb is None:
+        p.error("--output pyfsdb needs the pyfsdb module")
+    if parg.groupby:
+        if not do_aggregate(parg):
+            exit(1)
+        exit(0)
+
+    if parg.nocache:
+        parg.cache = None
+    if parg.cache and (parg.stream or parg.pit or parg.size > 0):
+        print("WARNING: --cache is not used with --stream, --pit or --size", file=sys.stderr)
+        parg.cache = None
+    if parg.cache and es_cache.pa is None:
+        print("WARNING: --cache needs the pyarrow module, not caching", file=sys.stderr)
+        parg.cache = None
+
+    if parg.stream or parg.pit:
+        if not do_stream(parg):
+            exit(1)
+        exit(0)
+
+    sink = None
+    if parg.output != "fsdb":
+        sink = lambda cols: open_sink(parg, cols)
+
+    if parg.cache:
+        if not do_cached(parg, sink):
+            exit(1)
+        exit(0)
+
     data = do_extract(parg)
     if not data:
         print("Query to elasticsearch failed")
@@ -237,7 +860,8 @@ def main(argv):
 
     #datastr = json.dumps(data)
     #print(datastr)
-    write_to_fsdb(parg.outfile, data, parg.fields, parg.addheader, parg.flatten, parg.timecol)
+    if not write_to_fsdb(parg.outfile, data, parg.fields, parg.addheader, parg.flatten, parg.timecol, sink):
+        exit(1)
 
     exit(0)
     
@@ -0,0 +1,337 @@
+#
+# Parquet / Arrow archive dumper for ES-to-ES.py --dump
+#
+# With --dumper parquet (or arrow) each index is written as columnar
+# files instead of NDJSON, laid out in hive style partitions:
+#
+#   <dump_dir>/host=<host>/day=<YYYY-MM-DD>/<index>.<slice>.parquet
+#
+# The host is the part of the index name before the first "-", which is
+# how the copy scripts name their copies.  The day comes from each
+# document's @timestamp.  Columns come from the index _mapping, with
+# object fields flattened with "_" like es-to-fsdb.py --flatten, so
+# readers can load just the columns and days they need.  Values that do
+# not fit their mapped type, and fields missing from the mapping, are
+# kept as JSON in the _unparsed column.
+#
+# An index is done once its host=<host>/_<index>.done file exists; files
+# are written under hidden .tmp names until the whole index is read.
+#
+
+import os
+import glob
+import json
+from time import time
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+
+from es_http import es_run, BadConnection
+import es_flatten
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+
+TIME_FIELD  = "@timestamp"
+SCROLL_WAIT = "5m"
+NO_DAY      = "unknown"         # partition for documents without TIME_FIELD
+
+SUFFIX = { "parquet": ".parquet", "arrow": ".arrow" }
+
+
+def add_archive_args(clparse):
+    clparse.add_argument('--archive_rows', type=int, default=50000,
+                         help='with --dumper parquet or arrow, rows per row group or record batch (50000)')
+
+# end add_archive_args
+
+
+def to_int(v):
+    if isinstance(v, bool) or (isinstance(v, float) and not v.is_integer()) :
+        raise ValueError(v)
+    return int(v)
+
+
+def to_float(v):
+    if isinstance(v, bool) :
+        raise ValueError(v)
+    return float(v)
+
+
+def to_bool(v):
+    if isinstance(v, bool) :
+        return v
+    if v in ("true", "false") :
+        return v == "true"
+    raise ValueError(v)
+
+
+def to_time(v):
+    if isinstance(v, str) and v.strip().isdigit() :
+        v = int(v)
+    if isinstance(v, (int, float)) and not isinstance(v, bool) :
+        return datetime.fromtimestamp(v / 1000.0, timezone.utc)
+    s = v.strip()
+    if s.endswith("Z") :
+        s = s[:-1] + "+00:00"
+    t = datetime.fromisoformat(s)
+    if t.tzinfo is None :
+        t = t.replace(tzinfo=timezone.utc)
+    return t
+
+
+def to_str(v):
+    if isinstance(v, (list, dict)) :
+        return json.dumps(v)
+    if isinstance(v, bool) :
+        return "true" if v else "false"
+    return str(v)
+
+
+def column_type(es_type):
+    # (arrow type, converter) for an ES field type, anything else is text
+    if es_type in ("long", "integer", "short", "byte") :
+        return (pa.int64(), to_int)
+    if es_type in ("double", "float", "half_float", "scaled_float") :
+        return (pa.float64(), to_float)
+    if es_type == "boolean" :
+        return (pa.bool_(), to_bool)
+    if es_type == "date" :
+        return (pa.timestamp("ms", tz="UTC"), to_time)
+    if es_type == "date_nanos" :
+        return (pa.timestamp("us", tz="UTC"), to_time)
+    return (pa.string(), to_str)
+
+# end column_type
+
+
+def index_schema(args, index):
+    # returns (arrow schema, [(column, converter)]) from the index _mapping
+    mapping_d = es_run(args, "GET", "http://localhost:%d/%s/_mapping" %
+                       ( args.lport, index ))
+    properties = es_flatten.index_properties(mapping_d, index)
+    if not properties :
+        raise Exception("index_schema: no mapping for %s: %s" %
+                        (index, mapping_d))
+
+    fields  = [ pa.field("_id", pa.string()) ]
+    columns = []
+    for (col, path, es_type) in es_flatten.mapping_columns(properties,
+                                                           reserved=("_id", "_unparsed")) :
+        (pa_type, conv) = column_type(es_type)
+        fields.append(pa.field(col, pa_type))
+        columns.append((col, path, conv))
+    fields.append(pa.field("_unparsed", pa.string()))
+
+    return (pa.schema(fields), columns)
+
+# end index_schema
+
+
+def archive_paths(args, index):
+    host = index.split("-", 1)[0] if "-" in index else "unknown"
+    host_dir = os.path.join(args.dump_dir, "host=" + host)
+    return (host_dir, os.path.join(host_dir, "_%s.done" % (index)))
+
+# end archive_paths
+
+
+class SliceWriter(object):
+    # one open file per day for one scroll slice
+    def __init__(self, args, host_dir, index, slice_id, schema):
+        self.args     = args
+        self.host_dir = host_dir
+        self.name     = "%s.%d%s" % (index, slice_id, SUFFIX[args.dumper])
+        self.schema   = schema
+        self.rows     = {}      # day : [row]
+        self.writers  = {}      # day : (writer, tmp path, final path)
+
+    def add(self, day, row):
+        rows = self.rows.setdefault(day, [])
+        rows.append(row)
+        if len(rows) >= self.args.archive_rows :
+            self.flush(day)
+
+    def open(self, day):
+        day_dir = os.path.join(self.host_dir, "day=" + day)
+        os.makedirs(day_dir, exist_ok=True)
+        final = os.path.join(day_dir, self.name)
+        tmp   = os.path.join(day_dir, "." + self.name + ".tmp")
+
+        if self.args.dumper == "parquet" :
+            codec = { "gzip": "gzip", "zstd": "zstd", "none": "none" }
+            writer = pq.ParquetWriter(tmp, self.schema,
+                                      compression=codec[self.args.compress])
+        else :
+            options = pa.ipc.IpcWriteOptions(
+                compression=None if self.args.compress == "none" else "zstd")
+            writer = pa.ipc.new_file(tmp, self.schema, options=options)
+
+        self.writers[day] = (writer, tmp, final)
+
+    def flush(self, day):
+        rows = self.rows.pop(day, [])
+        if not rows :
+            return
+        if day not in self.writers :
+            self.open(day)
+        cols = { f.name: [ r[i] for r in rows ]
+                 for (i, f) in enumerate(self.schema) }
+        table = pa.Table.from_pydict(cols, schema=self.schema)
+        self.writers[day][0].write_table(table)
+
+    def close(self, keep):
+        # keep is False when the slice stopped halfway
+        if keep :
+            for day in list(self.rows) :
+                self.flush(day)
+        done = []
+        for (writer, tmp, final) in self.writers.values() :
+            writer.close()
+            if keep :
+                done.append((tmp, final))
+            else :
+                os.remove(tmp)
+        return done
+
+# end SliceWriter
+
+
+def make_row(hit, columns, leaves):
+    # returns (day, row) with the values in schema order
+    # keyed by dotted path, which unlike the column names can't collide
+    doc = es_flatten.flatten_doc(hit.get("_source", {}), sep=".", keep=leaves)
+    row = [ hit["_id"] ]
+    day = NO_DAY
+
+    for (col, path, conv) in columns :
+        v = doc.pop(path, None)
+        if v is not None :
+            try:
+                v = conv(v)
+            except (ValueError, TypeError, AttributeError, OverflowError):
+                doc[path] = v       # keep it as it came
+                v = None
+        if path == TIME_FIELD and isinstance(v, datetime) :
+            day = v.strftime("%Y-%m-%d")
+        row.append(v)
+
+    row.append(json.dumps(doc) if doc else None)
+    return (day, row)
+
+# end make_row
+
+
+def archive_slice(args, index, slice_id, slices, host_dir, schema, columns):
+    body = { "size": args.scroll_size, "sort": [ "_doc" ],
+             "query": { "match_all": {} } }
+    if slices > 1 :
+        body["slice"] = { "id": slice_id, "max": slices }
+
+    writer = SliceWriter(args, host_dir, index, slice_id, schema)
+    leaves = set(path for (col, path, conv) in columns)
+    docs = 0
+    days = set()
+    keep = False
+    scroll_id = None
+    try:
+        res = es_run(args, "POST", "http://localhost:%d/%s/_search?scroll=%s" %
+                     ( args.lport, index, SCROLL_WAIT ), body)
+        while True :
+            if "hits" not in res :
+                raise Exception("archive_slice: scroll failed on %s: %s" %
+                                (index, res))
+            scroll_id = res.get("_scroll_id", scroll_id)
+            hits = res["hits"]["hits"]
+            if not hits :
+                break
+
+            for hit in hits :
+                (day, row) = make_row(hit, columns, leaves)
+                writer.add(day, row)
+                days.add(day)
+            docs += len(hits)
+
+            res = es_run(args, "POST",
+                         "http://localhost:%d/_search/scroll" % ( args.lport ),
+                         { "scroll": SCROLL_WAIT, "scroll_id": scroll_id })
+        keep = True
+
+    finally:
+        done = writer.close(keep)
+        if scroll_id :
+            try:
+                es_run(args, "DELETE",
+                       "http://localhost:%d/_search/scroll" % ( args.lport ),
+                       { "scroll_id": scroll_id })
+            except BadConnection:
+                pass
+
+    return (docs, days, done)
+
+# end archive_slice
+
+
+def archive_index(args, index):
+    (host_dir, done_path) = archive_paths(args, index)
+    if os.path.exists(done_path) :
+        return "    WARNING: Already archived, Skipping: %s\n" % (done_path)
+
+    # left behind by an interrupted run
+    for tmp in glob.glob(os.path.join(host_dir, "day=*",
+                                      ".%s.*.tmp" % (glob.escape(index)))) :
+        os.remove(tmp)
+
+    (schema, columns) = index_schema(args, index)
+    slices = max(1, args.dump_slices)
+
+    start = time()
+    with ThreadPoolExecutor(max_workers=slices) as pool:
+        results = list(pool.map(lambda i: archive_slice(args, index, i, slices,
+                                                        host_dir, schema,
+                                                        columns),
+                                range(slices)))
+
+    docs = 0
+    days = set()
+    for (n, d, done) in results :
+        docs += n
+        days |= d
+        for (tmp, final) in done :
+            os.replace(tmp, final)
+
+    with open(done_path, "w") as fp:
+        json.dump({ "index": index, "docs": docs, "days": sorted(days),
+                    "columns": len(schema) }, fp)
+
+    return ("dump: archived: \'%s\'\n           to: \'%s\' (%d days)\n"
+            "    %d documents, %d columns in %.1f s" %
+            (index, host_dir, len(days), docs, len(schema), time() - start))
+
+# end archive_index
+
+
+def archive_indices(args, index_list):
+    if pa is None :
+        print("Error: archive_indices: --dumper %s needs the pyarrow module" %
+              (args.dumper))
+        return False
+
+    def archive_one(index):
+        try:
+            print(archive_index(args, index))
+        except Exception as e:
+            print("Error: archive_indices: archive of \'%s\' failed: %s" %
+                  (index, e))
+            return False
+        return True
+
+    with ThreadPoolExecutor(max_workers=max(1, args.dump_jobs)) as pool:
+        results = list(pool.map(archive_one, index_list))
+
+    return all(results)
+
+# end archive_indices
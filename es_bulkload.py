@@ -0,0 +1,104 @@
+#
+# Bulk-load profile for destination indexes, used by the ES copy scripts
+#
+# With --bulk_load a newly created destination index gets
+# refresh_interval -1 and no replicas (and with --translog_async, async
+# translog durability) while it is being filled.  Afterwards the index
+# is refreshed and its count checked against the source.  The settings
+# the index had before are put back either way, and only a verified copy
+# is force merged (--force_merge).
+#
+
+from es_http import es_run
+
+
+BULK_SETTINGS = { "index.refresh_interval":   "-1",
+                  "index.number_of_replicas": 0 }
+
+TRANSLOG_SETTINGS = { "index.translog.durability":           "async",
+                      "index.translog.flush_threshold_size": "1gb" }
+
+
+def add_bulkload_args(clparse):
+    clparse.add_argument('--bulk_load', action='store_true', default=False,
+                         help='no refresh and no replicas on new indexes while copying')
+    clparse.add_argument('--translog_async', action='store_true', default=False,
+                         help='with --bulk_load, also use async translog durability while copying')
+    clparse.add_argument('--force_merge', type=int, default=0,
+                         help='with --bulk_load, force merge verified copies to this many segments (off)')
+
+# end add_bulkload_args
+
+
+def prepare(args, to_index):
+    # returns the settings to put back after the copy, None when off
+    if not args.bulk_load :
+        return None
+
+    profile = dict(BULK_SETTINGS)
+    if args.translog_async :
+        profile.update(TRANSLOG_SETTINGS)
+
+    settings_d = es_run(args, "GET",
+                        "http://localhost:9200/%s/_settings?flat_settings=true" %
+                        ( to_index ))
+    current = settings_d.get(to_index, {}).get("settings", {})
+
+    # settings the index did not set itself go back to null, which
+    # leaves them at the cluster or template default
+    saved = { k: current.get(k) for k in profile }
+
+    put_d = es_run(args, "PUT",
+                   "http://localhost:9200/%s/_settings" % ( to_index ), profile)
+    if not put_d.get("acknowledged") :
+        print("Error: bulkload prepare: settings not applied:\n  %s" % (put_d))
+
+    if args.verbose :
+        print("    bulk load settings: %s" % (profile))
+
+    return saved
+
+# end prepare
+
+
+def verify(args, from_index, to_index):
+    es_run(args, "POST", "http://localhost:9200/%s/_refresh" % ( to_index ))
+
+    to_d   = es_run(args, "GET", "http://localhost:9200/%s/_count" %
+                    ( to_index ))
+    from_d = es_run(args, "GET", "http://localhost:%d/%s/_count" %
+                    ( args.lport, from_index ))
+
+    if "count" in from_d and from_d.get("count") == to_d.get("count") :
+        return True
+
+    print("    Copy not verified: %s:%s != %s:%s" %
+          (from_index, from_d.get("count"), to_index, to_d.get("count")))
+    return False
+
+# end verify
+
+
+def finish(args, from_index, to_index, saved, copied):
+    # copied is False when the copy stopped halfway
+    if saved is None :
+        return
+
+    ok = copied and verify(args, from_index, to_index)
+
+    put_d = es_run(args, "PUT",
+                   "http://localhost:9200/%s/_settings" % ( to_index ), saved)
+    if not put_d.get("acknowledged") :
+        print("Error: bulkload finish: settings not restored on %s:\n  %s" %
+              (to_index, put_d))
+    elif args.verbose :
+        print("    restored settings: %s" % (saved))
+
+    if ok and args.force_merge > 0 :
+        print("    Force merging %s to %d segments" %
+              (to_index, args.force_merge))
+        es_run(args, "POST",
+               "http://localhost:9200/%s/_forcemerge?max_num_segments=%d" %
+               ( to_index, args.force_merge ))
+
+# end finish
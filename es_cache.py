@@ -0,0 +1,132 @@
+#
+# Local result cache for es-to-fsdb.py --cache
+#
+# Each query's rows are kept in a parquet file named by a hash of the
+# search body and index, with the newest time seen (the watermark) in the
+# file's metadata.  A repeat of the query only fetches documents from the
+# watermark on and merges them in, replacing cached rows with the same
+# _id.  Files are used most recently first; once the cache is larger than
+# its limit the least recently used files are removed.
+#
+# Documents indexed later with a time before the watermark are not seen;
+# use --no-cache to fetch everything again.
+#
+
+import os
+import json
+import hashlib
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+
+SUFFIX = ".parquet"
+WATERMARK = b"es_cache.watermark"
+ID_COL = "_id"          # document _id, to merge refetched documents
+TIME_COL = "_ts"        # epoch seconds of each row's time, UTC
+
+
+def cache_key(body, index, extra=None):
+    # the same query gives the same key, whatever order its keys are in
+    key = { "body": body, "index": sorted(set(str(index).split(","))),
+            "extra": extra }
+    text = json.dumps(key, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:32]
+
+# end cache_key
+
+
+def cache_path(cache_dir, key):
+    return os.path.join(cache_dir, key + SUFFIX)
+
+# end cache_path
+
+
+def load_cache(cache_dir, key):
+    # returns (DataFrame, watermark), (None, None) when the query isn't cached
+    path = cache_path(cache_dir, key)
+    if not os.path.exists(path) :
+        return (None, None)
+    try:
+        table = pq.read_table(path)
+    except Exception as e:
+        print("WARNING: load_cache: can't read %s, not using it: %s" % (path, e))
+        return (None, None)
+
+    # used now, for the LRU order
+    os.utime(path)
+
+    meta = table.schema.metadata or {}
+    watermark = meta.get(WATERMARK)
+    if watermark is not None :
+        watermark = float(watermark)
+    return (table.to_pandas(), watermark)
+
+# end load_cache
+
+
+def merge_rows(old, new):
+    # new rows replace old ones with the same _id, columns new to the
+    # cache are empty in the old rows
+    if old is None or not len(old) :
+        return new
+    if not len(new) :
+        return old
+    df = pd.concat([old, new], ignore_index=True, sort=False)
+    df = df.drop_duplicates(subset=[ID_COL], keep="last")
+    text = [ c for c in df.columns if df[c].dtype == object ]
+    df[text] = df[text].fillna("")
+    return df.reset_index(drop=True)
+
+# end merge_rows
+
+
+def save_cache(cache_dir, key, df, watermark, max_bytes):
+    os.makedirs(cache_dir, exist_ok=True)
+    path = cache_path(cache_dir, key)
+    tmp  = os.path.join(cache_dir, "." + key + ".tmp")
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    meta = dict(table.schema.metadata or {})
+    if watermark is not None :
+        meta[WATERMARK] = repr(float(watermark)).encode("ascii")
+    table = table.replace_schema_metadata(meta)
+
+    pq.write_table(table, tmp, compression="zstd")
+    os.replace(tmp, path)
+
+    evict_cache(cache_dir, max_bytes, keep=path)
+
+# end save_cache
+
+
+def evict_cache(cache_dir, max_bytes, keep=None):
+    # removes the least recently used files until the cache fits
+    files = []
+    for name in os.listdir(cache_dir) :
+        if not name.endswith(SUFFIX) :
+            continue
+        path = os.path.join(cache_dir, name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        files.append((st.st_mtime, st.st_size, path))
+
+    total = sum(size for (mtime, size, path) in files)
+    for (mtime, size, path) in sorted(files) :
+        if total <= max_bytes :
+            break
+        if path == keep :
+            continue
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+
+# end evict_cache
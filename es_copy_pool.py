@@ -0,0 +1,319 @@
+#
+# Worker pool shared by ES-to-ES.py and tpot-ES-to-ES.py
+#
+# Each host is copied by its own worker, with its own ssh tunnel on its
+# own local port (--lport + host number).  Indices from one host are
+# copied by at most --host_jobs threads, so a fragile T-Pot never sees
+# more than that many reindexes at once.
+#
+# print() output from the workers is buffered per index and per host and
+# written out as one block when the host is done, followed by a summary
+# table for all hosts.
+#
+# A connection failure only stops the host it happened on, and a
+# reindex that left part of an index uncopied (es_reindex.ReindexFailed)
+# only marks that index as an error.  Any other error stops every host
+# from starting new indexes and is raised again once the summary is
+# printed.
+#
+
+import sys
+import io
+import copy
+import threading
+import traceback
+from time import time
+from concurrent.futures import ThreadPoolExecutor
+
+from es_http import BadConnection
+import es_manifest
+import es_reindex
+
+
+# column order for the summary table, anything else is appended
+STATUS_ORDER = ["copied", "recopied", "repaired", "exists", "settled",
+                "missing", "error", "skipped"]
+
+MAX_PORT = 65535
+
+# set by the first unexpected error, every host stops at its next index
+aborted = threading.Event()
+
+
+class HostStats(object):
+    def __init__(self, host):
+        self.host    = host
+        self.lport   = None
+        self.indices = 0
+        self.docs    = 0
+        self.status  = {}
+        self.error   = None
+        self.exc     = None
+        self.start   = time()
+        self.elapsed = 0.0
+        self.lock    = threading.Lock()
+
+    def add(self, status, docs=0):
+        with self.lock:
+            self.indices += 1
+            self.docs    += docs
+            self.status[status] = self.status.get(status, 0) + 1
+
+# end HostStats
+
+
+class GroupedStdout(object):
+    # stands in for sys.stdout; threads that have a buffer set print into
+    # it, every other thread prints straight through
+    def __init__(self, real):
+        self.real  = real
+        self.local = threading.local()
+        self.lock  = threading.Lock()
+
+    def write(self, s):
+        buf = getattr(self.local, "buf", None)
+        if buf is None :
+            with self.lock:
+                return self.real.write(s)
+        return buf.write(s)
+
+    def flush(self):
+        if getattr(self.local, "buf", None) is None :
+            self.real.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.real, name)
+
+    def capture(self):
+        buf = io.StringIO()
+        self.local.buf = buf
+        return buf
+
+    def release(self):
+        buf = getattr(self.local, "buf", None)
+        self.local.buf = None
+        return buf.getvalue() if buf is not None else ""
+
+# end GroupedStdout
+
+
+def add_pool_args(clparse):
+    clparse.add_argument('--jobs', type=int, default=1,
+                         help='number of hosts to copy from at the same time (1)')
+    clparse.add_argument('--host_jobs', type=int, default=1,
+                         help='maximum number of indexes copied at the same time from any one host (1)')
+
+# end add_pool_args
+
+
+def _grouped():
+    if isinstance(sys.stdout, GroupedStdout) :
+        return sys.stdout
+    return None
+
+
+def _copy_one(args, host, from_index, to_index, check_copy, stats, halt,
+              buffered):
+    out = _grouped()
+    if buffered :
+        out.capture()
+
+    try:
+        settled = es_manifest.is_settled(args, host, from_index, to_index)
+
+        if halt.is_set() or aborted.is_set() :
+            stats.add("skipped")
+        elif settled :
+            if args.verbose :
+                print("%s: %s  settled, %d documents: Skipping" %
+                      ( host, from_index, settled["doc_count"] ) )
+            stats.add("settled")
+        else :
+            print("%s: %s  to localhost: %s" % ( host, from_index, to_index ) )
+            sys.stdout.flush()
+
+            status, docs, count = check_copy(args, from_index, to_index)
+            stats.add(status, docs)
+            es_manifest.record(args, host, from_index, to_index, status, count)
+
+    except BadConnection:
+        if not halt.is_set() :
+            halt.set()
+            print("\nError: failed to connect to %s" % (host))
+            print("         skipping the rest of coyping for %s\n" % (host))
+            stats.error = "connection failed"
+        stats.add("error")
+
+    except es_reindex.ReindexFailed as e:
+        print("Error: %s: %s" % ( host, e ))
+        stats.add("error")
+        es_manifest.record(args, host, from_index, to_index, "error", None)
+
+    except Exception as e:
+        # anything else stops the run, copy_indices raises it again
+        halt.set()
+        aborted.set()
+        traceback.print_exc(file=sys.stdout)
+        with stats.lock:
+            if stats.exc is None :
+                stats.exc = e
+                stats.error = repr(e)
+        stats.add("error")
+
+    if buffered :
+        return out.release()
+    return ""
+
+# end _copy_one
+
+
+def copy_indices(args, host, pairs, check_copy, stats, should_stop=None):
+    # pairs is a list of (from_index, to_index); check_copy(args, from, to)
+    # returns (status, docs_created, source_count)
+    halt = threading.Event()
+    host_jobs = max(1, args.host_jobs)
+
+    if host_jobs == 1 :
+        for (from_index, to_index) in pairs :
+            if should_stop and should_stop() :
+                break
+            _copy_one(args, host, from_index, to_index, check_copy, stats,
+                      halt, False)
+            if halt.is_set() :
+                break
+        if stats.exc is not None :
+            raise stats.exc
+        return
+
+    # several indexes at once: each index prints into its own buffer and
+    # the buffers are written out in index order
+
+    # only hand out an index once a slot is free, so should_stop() sees
+    # the results of the copies before it
+    slots = threading.BoundedSemaphore(host_jobs)
+
+    with ThreadPoolExecutor(max_workers=host_jobs) as pool:
+        futures = []
+        for (from_index, to_index) in pairs :
+            slots.acquire()
+            if ( should_stop and should_stop() ) or halt.is_set() or \
+               aborted.is_set() :
+                slots.release()
+                break
+            f = pool.submit(_copy_one, args, host, from_index, to_index,
+                            check_copy, stats, halt, True)
+            f.add_done_callback(lambda f: slots.release())
+            futures.append(f)
+
+        for f in futures :
+            sys.stdout.write(f.result())
+        sys.stdout.flush()
+
+    if stats.exc is not None :
+        raise stats.exc
+
+# end copy_indices
+
+
+def _run_host(args, host, lport, copy_host, buffered):
+    hargs = copy.copy(args)
+    hargs.lport = lport
+    stats = HostStats(host)
+    stats.lport = lport
+
+    if aborted.is_set() :
+        stats.error = "not started"
+        return stats
+
+    out = _grouped()
+    if buffered :
+        out.capture()
+
+    try:
+        print("\nConnecting to: %s" % str(host))  # separate host output
+        copy_host(hargs, host, stats)
+    except Exception as e:
+        # raised again by run_hosts after the summary
+        aborted.set()
+        if stats.exc is not e :
+            traceback.print_exc(file=sys.stdout)
+        stats.exc = e
+        stats.error = repr(e)
+    finally:
+        stats.elapsed = time() - stats.start
+        if aborted.is_set() and stats.error is None :
+            stats.error = "stopped"
+        if buffered :
+            text = out.release()
+            with out.lock:
+                out.real.write(text)
+                out.real.flush()
+
+    return stats
+
+# end _run_host
+
+
+def run_hosts(args, hosts_list, copy_host, summary=True):
+    # copy_host(hargs, host, stats) does all the work for one host, hargs
+    # is a copy of args with lport set to this host's tunnel port
+    jobs = max(1, min(args.jobs, len(hosts_list)))
+    lports = [args.lport + i for i in range(len(hosts_list))]
+    if lports and lports[-1] > MAX_PORT :
+        print("Error: run_hosts: --lport %d + %d hosts goes past port %d" %
+              ( args.lport, len(hosts_list), MAX_PORT ))
+        sys.exit(1)
+    aborted.clear()
+
+    real_stdout = sys.stdout
+    if jobs > 1 or args.host_jobs > 1 :
+        sys.stdout = GroupedStdout(real_stdout)
+
+    try:
+        if jobs == 1 :
+            results = []
+            for (host, lport) in zip(hosts_list, lports) :
+                results.append(_run_host(args, host, lport, copy_host, False))
+                if aborted.is_set() :
+                    break
+        else :
+            with ThreadPoolExecutor(max_workers=jobs) as pool:
+                results = list(pool.map(
+                    lambda hl: _run_host(args, hl[0], hl[1], copy_host, True),
+                    zip(hosts_list, lports)))
+    finally:
+        sys.stdout = real_stdout
+
+    if summary :
+        print_summary(results)
+    for r in results :
+        if r.exc is not None :
+            raise r.exc
+    return results
+
+# end run_hosts
+
+
+def print_summary(results):
+    statuses = [s for s in STATUS_ORDER
+                if any(s in r.status for r in results)]
+    for r in results :
+        statuses.extend(sorted(s for s in r.status if s not in statuses))
+
+    width = max([len("host")] + [len(r.host) for r in results])
+    header = ["%-*s" % (width, "host"), "%7s" % "indices"]
+    header += ["%8s" % s for s in statuses]
+    header += ["%12s" % "docs", "%9s" % "seconds", " result"]
+
+    print("\nSummary:\n")
+    print(" ".join(header))
+    for r in results :
+        line = ["%-*s" % (width, r.host), "%7d" % r.indices]
+        line += ["%8d" % r.status.get(s, 0) for s in statuses]
+        line += ["%12d" % r.docs, "%9.1f" % r.elapsed,
+                 " " + (r.error if r.error else "ok")]
+        print(" ".join(line))
+    print("")
+    sys.stdout.flush()
+
+# end print_summary
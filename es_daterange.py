@@ -0,0 +1,218 @@
+#
+# Index pruning for date range queries, used by es-to-fsdb.py and esdata
+#
+# T-Pot keeps its data in daily indexes (logstash-YYYY.MM.DD).  Rather
+# than sending a date range query to _all, which touches every shard of
+# every index on the cluster, the days the range covers are worked out
+# and matched against the daily indexes that exist.  Only those are
+# queried; months that are covered completely are named with a wildcard
+# (logstash-2021.05.*) to keep the URL short.
+#
+# The range bounds are read like ES reads them: ISO-8601 dates, epoch
+# millis (or seconds with an epoch_second format) and "now" or "date||"
+# date math.  Anything that can not be read turns pruning off; the index
+# list only ever covers more than the range, never less.
+#
+
+import re
+import fnmatch
+import calendar
+from datetime import datetime, timedelta, timezone
+
+
+DAILY_PATTERN = "logstash-%Y.%m.%d"
+
+LOWER = ("gte", "gt", "from")
+UPPER = ("lte", "lt", "to")
+
+DATE_MATH = re.compile(r'^((?:[+-]\d+[yMwdhHms])*)(?:/([yMwdhHms]))?$')
+DATE_STEP = re.compile(r'([+-])(\d+)([yMwdhHms])')
+
+# units of a fixed length; months and years are added on the calendar
+UNIT_SECS = { "w": 7 * 86400, "d": 86400, "h": 3600, "H": 3600, "m": 60, "s": 1 }
+
+
+def parse_time(value, fmt=None, now=None):
+    # returns a UTC datetime, or None when value can't be read
+    value = str(value).strip()
+    if value.isdigit() :
+        secs = int(value)
+        if not (fmt and "epoch_second" in fmt) :
+            secs = secs / 1000.0
+        return datetime.fromtimestamp(secs, timezone.utc)
+
+    s = value
+    if s.endswith("Z") :
+        s = s[:-1] + "+00:00"
+    try:
+        t = datetime.fromisoformat(s)
+    except ValueError:
+        return None
+    if t.tzinfo is None :
+        t = t.replace(tzinfo=timezone.utc)
+    return t.astimezone(timezone.utc)
+
+# end parse_time
+
+
+def add_months(t, months):
+    # calendar month arithmetic the way ES does it: the day is kept, or
+    # is the last day of a shorter month (Jan 31 + 1M is Feb 28)
+    n = t.year * 12 + t.month - 1 + months
+    (year, month) = divmod(n, 12)
+    day = min(t.day, calendar.monthrange(year, month + 1)[1])
+    return t.replace(year=year, month=month + 1, day=day)
+
+# end add_months
+
+
+def parse_bound(value, upper, fmt=None, now=None):
+    # one range bound as a UTC datetime, date math included; None when it
+    # can't be read
+    if now is None :
+        now = datetime.now(timezone.utc)
+    value = str(value).strip()
+
+    if value.startswith("now") :
+        (t, math) = (now, value[3:])
+    elif "||" in value :
+        (anchor, math) = value.split("||", 1)
+        t = parse_time(anchor, fmt)
+    else :
+        (t, math) = (parse_time(value, fmt), "")
+    if t is None :
+        return None
+
+    m = DATE_MATH.match(math)
+    if not m :
+        return None
+    for (sign, n, unit) in DATE_STEP.findall(m.group(1)) :
+        n = int(n) if sign == "+" else -int(n)
+        if unit == "y" :
+            t = add_months(t, 12 * n)
+        elif unit == "M" :
+            t = add_months(t, n)
+        else :
+            t += timedelta(seconds=n * UNIT_SECS[unit])
+
+    if m.group(2) :
+        t = round_time(t, m.group(2), upper)
+    return t
+
+# end parse_bound
+
+
+def round_time(t, unit, upper):
+    # the start of t's unit, or for an upper bound its last millisecond;
+    # ES rounds gt and lt the other way, this only ever widens the range
+    if unit == "y" :
+        start = t.replace(month=1, day=1, hour=0, minute=0, second=0, microsecond=0)
+        end = add_months(start, 12)
+    elif unit == "M" :
+        start = t.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        end = add_months(start, 1)
+    elif unit == "w" :
+        start = t.replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=t.weekday())
+        end = start + timedelta(days=7)
+    elif unit == "d" :
+        start = t.replace(hour=0, minute=0, second=0, microsecond=0)
+        end = start + timedelta(days=1)
+    elif unit in ("h", "H") :
+        start = t.replace(minute=0, second=0, microsecond=0)
+        end = start + timedelta(hours=1)
+    elif unit == "m" :
+        start = t.replace(second=0, microsecond=0)
+        end = start + timedelta(minutes=1)
+    else :
+        start = t.replace(microsecond=0)
+        end = start + timedelta(seconds=1)
+    return end - timedelta(milliseconds=1) if upper else start
+
+# end round_time
+
+
+def range_days(bounds, now=None):
+    # bounds is { "gte": ..., "lte": ..., "format": ..., "time_zone": ... }
+    # returns (first day, last day), either None when open, or None when
+    # the range can't be read
+    fmt = bounds.get("format")
+    days = []
+    for (names, upper) in ((LOWER, False), (UPPER, True)) :
+        day = None
+        for name in names :
+            if name in bounds :
+                t = parse_bound(bounds[name], upper, fmt, now)
+                if t is None :
+                    return None
+                day = t.date()
+                break
+        days.append(day)
+
+    (first, last) = days
+    # a time_zone moves naive times up to a day either way
+    if "time_zone" in bounds :
+        if first : first -= timedelta(days=1)
+        if last :  last += timedelta(days=1)
+    return (first, last)
+
+# end range_days
+
+
+def daily_indices(names, pattern, first, last):
+    # the names that are daily indexes from first to last (inclusive,
+    # None is open), None when none of names is a daily index at all
+    daily = {}
+    for name in names :
+        try:
+            daily[name] = datetime.strptime(name, pattern).date()
+        except ValueError:
+            pass
+    if not daily :
+        return None
+
+    wanted = sorted(n for (n, d) in daily.items()
+                    if (first is None or d >= first) and (last is None or d <= last))
+
+    if "%d" not in pattern :
+        return wanted
+
+    # a month whose every index is wanted goes as one wildcard
+    out = []
+    done = set()
+    for name in wanted :
+        month = daily[name].strftime(pattern.replace("%d", "*"))
+        if month in done :
+            continue
+        matches = [n for n in names if fnmatch.fnmatchcase(n, month)]
+        if all(n in wanted for n in matches) :
+            out.append(month)
+            done.add(month)
+        else :
+            out.append(name)
+    return out
+
+# end daily_indices
+
+
+def existing_indices(es, pattern):
+    # names of the indexes that could be daily ones, from an
+    # elasticsearch client
+    glob = pattern.split("%", 1)[0] + "*"
+    try:
+        return [ row["index"] for row in es.cat.indices(index=glob, h="index",
+                                                        format="json") ]
+    except Exception:
+        return []
+
+# end existing_indices
+
+
+def prune_indices(es, pattern, bounds, now=None):
+    # returns the list of indexes to query instead of _all, or None to
+    # leave the query as it is
+    days = range_days(bounds, now)
+    if days is None or days == (None, None) :
+        return None
+    return daily_indices(existing_indices(es, pattern), pattern, days[0], days[1])
+
+# end prune_indices
@@ -0,0 +1,240 @@
+#
+# Native index dumper for ES-to-ES.py --dump
+#
+# Takes the place of running elasticdump once per index.  Several
+# indexes (--dump_jobs) are dumped at once, each read with a sliced
+# scroll (--dump_slices) sorted on @timestamp.  Every slice writes
+# compressed NDJSON (one hit per line, like elasticdump) to its own file.
+#
+# Each page is written as a complete gzip member or zstd frame, and a
+# sidecar checkpoint records, per slice, the file size, the last
+# @timestamp written and the ids written at that time.  An interrupted
+# dump cuts each file back to its checkpoint and carries on from the
+# last @timestamp, instead of starting again or being skipped.
+#
+
+import os
+import json
+import gzip
+import threading
+from time import time
+from concurrent.futures import ThreadPoolExecutor
+
+from es_http import es_run, BadConnection
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+TIME_FIELD  = "@timestamp"
+SCROLL_WAIT = "5m"
+MISSING     = -(2 ** 63)        # sort value ES gives documents without TIME_FIELD
+
+SUFFIX = { "gzip": ".json.gz", "zstd": ".json.zst", "none": ".json" }
+
+
+def add_dump_args(clparse):
+    clparse.add_argument('--dumper', choices=["native", "elasticdump", "parquet", "arrow"],
+                         default="native",
+                         help='with --dump, dump NDJSON with the built in dumper or with elasticdump, or archive to Parquet or Arrow files (native)')
+    clparse.add_argument('--compress', choices=["gzip", "zstd", "none"],
+                         default="gzip",
+                         help='with --dump, compression of the dump files (gzip)')
+    clparse.add_argument('--dump_jobs', type=int, default=2,
+                         help='with --dump, indexes dumped at the same time (2)')
+    clparse.add_argument('--dump_slices', type=int, default=2,
+                         help='with --dump, scroll slices per index read at the same time (2)')
+
+# end add_dump_args
+
+
+def compress(args, data):
+    if args.compress == "gzip" :
+        return gzip.compress(data)
+    if args.compress == "zstd" :
+        return zstandard.ZstdCompressor().compress(data)
+    return data
+
+# end compress
+
+
+def dump_paths(args, index):
+    base = os.path.join(args.dump_dir, args.prefix + index)
+    slices = max(1, args.dump_slices)
+    if slices == 1 :
+        files = [ base + SUFFIX[args.compress] ]
+    else :
+        files = [ "%s.%d%s" % (base, i, SUFFIX[args.compress])
+                  for i in range(slices) ]
+    return (files, base + ".checkpoint.json")
+
+# end dump_paths
+
+
+class Checkpoint(object):
+    def __init__(self, path, slices):
+        self.path = path
+        self.lock = threading.RLock()
+        self.state = None
+        if os.path.exists(path) :
+            with open(path) as fp:
+                self.state = json.load(fp)
+            if self.state.get("slices") != slices :
+                self.state = None       # sliced differently, start over
+        if self.state is None :
+            self.state = { "slices": slices, "complete": False,
+                           "parts": [ { "size": 0, "docs": 0, "last": None,
+                                        "ids_at_last": [], "done": False }
+                                      for i in range(slices) ] }
+
+    def save(self):
+        with self.lock:
+            tmp = self.path + ".tmp"
+            with open(tmp, "w") as fp:
+                json.dump(self.state, fp)
+            os.replace(tmp, self.path)
+
+# end Checkpoint
+
+
+def dump_slice(args, index, slice_id, slices, path, ckpt):
+    part = ckpt.state["parts"][slice_id]
+    if part["done"] :
+        return part["docs"]
+
+    # anything past the last checkpoint is an unfinished page
+    with ckpt.lock:
+        if part["last"] is None :
+            part.update({ "size": 0, "docs": 0, "ids_at_last": [] })
+        last = part["last"]
+        seen_at_last = set(part["ids_at_last"])
+    with open(path, "ab") as fp:
+        fp.truncate(part["size"])
+
+    # documents without @timestamp sort first, so once a real time has
+    # been written they are all in the file already
+    query = { "match_all": {} }
+    if last is not None and last > MISSING :
+        query = { "range": { TIME_FIELD: { "gte": last,
+                                           "format": "epoch_millis" } } }
+
+    body = { "size": args.scroll_size, "query": query,
+             "sort": [ { TIME_FIELD: { "order": "asc", "missing": "_first",
+                                       "unmapped_type": "date" } } ] }
+    if slices > 1 :
+        body["slice"] = { "id": slice_id, "max": slices }
+
+    scroll_id = None
+    try:
+        res = es_run(args, "POST", "http://localhost:%d/%s/_search?scroll=%s" %
+                     ( args.lport, index, SCROLL_WAIT ), body)
+        while True :
+            if "hits" not in res :
+                raise Exception("dump_slice: scroll failed on %s: %s" %
+                                (index, res))
+            scroll_id = res.get("_scroll_id", scroll_id)
+            hits = res["hits"]["hits"]
+            if not hits :
+                break
+
+            # last and seen_at_last only go into the checkpoint together
+            # with the size of the file they match, once it is written
+            lines = []
+            for hit in hits :
+                sort_val = hit.pop("sort", [None])[0]
+                if sort_val is not None and sort_val == last :
+                    if hit["_id"] in seen_at_last :
+                        continue
+                    seen_at_last.add(hit["_id"])
+                elif sort_val is not None :
+                    last = sort_val
+                    seen_at_last = set([hit["_id"]])
+                hit.pop("_score", None)
+                lines.append(json.dumps(hit))
+
+            if lines :
+                data = compress(args, ("\n".join(lines) + "\n").encode("utf-8"))
+                with open(path, "ab") as fp:
+                    fp.write(data)
+                    fp.flush()
+                with ckpt.lock:
+                    part["last"] = last
+                    part["size"] += len(data)
+                    part["docs"] += len(lines)
+                    part["ids_at_last"] = list(seen_at_last)
+                    ckpt.save()
+
+            res = es_run(args, "POST",
+                         "http://localhost:%d/_search/scroll" % ( args.lport ),
+                         { "scroll": SCROLL_WAIT, "scroll_id": scroll_id })
+
+    finally:
+        if scroll_id :
+            try:
+                es_run(args, "DELETE",
+                       "http://localhost:%d/_search/scroll" % ( args.lport ),
+                       { "scroll_id": scroll_id })
+            except BadConnection:
+                pass
+
+    with ckpt.lock:
+        part["done"] = True
+        ckpt.save()
+    return part["docs"]
+
+# end dump_slice
+
+
+def dump_index(args, index):
+    (files, ckpt_path) = dump_paths(args, index)
+    slices = len(files)
+
+    if os.path.exists(ckpt_path) :
+        ckpt = Checkpoint(ckpt_path, slices)
+        if ckpt.state["complete"] :
+            return "    WARNING: Already dumped, Skipping: %s\n" % (files[0])
+        resumed = " (resuming)"
+    elif any(os.path.exists(f) for f in files) :
+        return "    WARNING: File Exists, Skipping: %s\n" % (files[0])
+    else :
+        ckpt = Checkpoint(ckpt_path, slices)
+        resumed = ""
+
+    start = time()
+    with ThreadPoolExecutor(max_workers=slices) as pool:
+        docs = sum(pool.map(lambda i: dump_slice(args, index, i, slices,
+                                                 files[i], ckpt),
+                            range(slices)))
+
+    ckpt.state["complete"] = True
+    ckpt.save()
+
+    return ("dump: dumped: \'%s\'%s\n           to: \'%s\'%s\n"
+            "    %d documents in %.1f s" %
+            (index, resumed, files[0], " (+%d)" % (slices - 1) if slices > 1 else "",
+             docs, time() - start))
+
+# end dump_index
+
+
+def dump_indices(args, index_list):
+    if args.compress == "zstd" and zstandard is None :
+        print("Error: dump_indices: --compress zstd needs the zstandard module")
+        return False
+
+    def dump_one(index):
+        try:
+            print(dump_index(args, index))
+        except Exception as e:
+            print("Error: dump_indices: dump of \'%s\' failed: %s" % (index, e))
+            return False
+        return True
+
+    with ThreadPoolExecutor(max_workers=max(1, args.dump_jobs)) as pool:
+        results = list(pool.map(dump_one, index_list))
+
+    return all(results)
+
+# end dump_indices
@@ -0,0 +1,184 @@
+#
+# Flattening of ES documents into columns, the same way es-to-fsdb.py
+# --flatten names them: object fields are joined to their parent with
+# "_" (geoip.location.lat becomes geoip_location_lat), everything else,
+# lists included, stays one column.
+#
+# Different fields can join to the same name (a_b and a.b both give
+# a_b).  A record keeps the last one, as --flatten always has; the
+# columns built from a mapping give each field its own name instead.
+#
+
+import re
+import ast
+from collections.abc import MutableMapping
+
+
+SEP = "_"
+
+
+def unique_key(taken, key, sep=SEP):
+    # key, or key_2, key_3, ... when a column of that name is taken already
+    if key not in taken:
+        return key
+    n = 2
+    while "%s%s%d" % (key, sep, n) in taken:
+        n += 1
+    return "%s%s%d" % (key, sep, n)
+
+
+# https://www.geeksforgeeks.org/python-convert-nested-dictionary-into-flattened-dictionary/
+def convert_flatten(d, parent_key ='', sep ='_'):
+    items = []
+    for k, v in d.items():
+        new_key = parent_key + sep + k if parent_key else k
+        if isinstance(v, MutableMapping):
+            items.extend(convert_flatten(v, new_key, sep = sep).items())
+        else:
+            items.append((new_key, v))
+    return dict(items)
+
+
+def flatten_doc(source, sep=SEP, keep=(), parent_key=''):
+    # one document's _source as { column : value }, values keep their type;
+    # objects under a column named in keep are left whole
+    rec = {}
+    for k, v in source.items():
+        new_key = parent_key + sep + k if parent_key else k
+        if isinstance(v, MutableMapping) and new_key not in keep:
+            rec.update(flatten_doc(v, sep, keep, new_key))
+        else:
+            rec[new_key] = v
+    return rec
+
+
+# es-to-fsdb.py used to build its text columns by running str() on each
+# top level value, cutting newlines out of that text and, with --flatten,
+# reading it back with ast.literal_eval to flatten the dicts.  The
+# functions below get the same strings from the decoded values directly
+# (decoded JSON objects are always plain dicts).
+
+BACKSLASH_N = re.compile(r'(?<=\\)n')
+
+def clean_str(s):
+    # a string inside a value after that round trip: newlines become
+    # spaces, and so does an n right after a backslash
+    if "\\" in s:
+        s = BACKSLASH_N.sub(' ', s)
+    return s.replace('\n', ' ')
+
+
+def clean_value(v):
+    if isinstance(v, str):
+        return clean_str(v)
+    if isinstance(v, dict):
+        return { clean_str(k): clean_value(x) for k, x in v.items() }
+    if isinstance(v, list):
+        return [ clean_value(x) for x in v ]
+    return v
+
+
+def fsdb_text(v):
+    # a top level value as one column
+    return str(v).strip().replace('\n', ' ').replace('\r', '').replace('\\n', ' ')
+
+
+def flatten_text(d, parent_key, rec, sep=SEP):
+    for k, v in d.items():
+        new_key = parent_key + sep + clean_str(k)
+        if isinstance(v, dict):
+            flatten_text(v, new_key, rec, sep=sep)
+        elif isinstance(v, str):
+            rec[new_key] = clean_str(v)
+        elif isinstance(v, list):
+            rec[new_key] = str(clean_value(v))
+        else:
+            rec[new_key] = str(v)
+
+
+def fsdb_record(source, flatten, sep=SEP):
+    # one document's _source as { column : text }, the same columns and
+    # text es-to-fsdb.py has always written (with or without --flatten)
+    if not flatten:
+        return { k: fsdb_text(v) for k, v in source.items() }
+    rec = {}
+    for k, v in source.items():
+        if isinstance(v, dict):
+            flatten_text(v, k, rec, sep=sep)
+        elif isinstance(v, str):
+            fval = fsdb_text(v)
+            if fval[:1] in ("{", "("):
+                # text that reads back as a dict was flattened too
+                try:
+                    for (fk, fv) in convert_flatten(ast.literal_eval(fval), sep=sep).items():
+                        rec[k + sep + fk] = str(fv)
+                except:
+                    rec[k] = fval
+            else:
+                rec[k] = fval
+        else:
+            rec[k] = fsdb_text(v)
+    return rec
+
+
+def mapping_fields(properties, parent_key='', points=True):
+    # [(dotted path, ES type)] for the leaves of an index _mapping, in
+    # mapping order; a geo_point object flattens to its lat and lon (unless
+    # points is False), other leaves (nested fields are lists of objects)
+    # stay one field
+    fields = []
+    for k, v in properties.items():
+        path = parent_key + "." + k if parent_key else k
+        if "properties" in v and v.get("type", "object") == "object":
+            fields.extend(mapping_fields(v["properties"], path, points))
+        elif v.get("type") == "geo_point" and points:
+            fields.extend([(path + ".lat", "double"), (path + ".lon", "double")])
+        else:
+            fields.append((path, v.get("type", "object")))
+    return fields
+
+
+def mapping_columns(properties, sep=SEP, reserved=()):
+    # [(column, dotted path, ES type)], the mapping_fields named as
+    # flattened columns, each name used once (reserved ones not at all).
+    # Names are handed out in dotted path order, so where fields collide
+    # the column a field gets doesn't depend on the mapping's key order.
+    fields = mapping_fields(properties)
+    taken = set(reserved)
+    names = {}
+    for (path, t) in sorted(fields):
+        names[path] = unique_key(taken, path.replace(".", sep), sep)
+        taken.add(names[path])
+    return [ (names[path], path, t) for (path, t) in fields ]
+
+
+def record_columns(properties, flatten, wanted=None, sep=SEP):
+    # The columns fsdb_record gives documents of an index _mapping, in
+    # mapping order, for the dotted paths wanted() keeps.  A geo_point can
+    # be an object (its _lat and _lon) or a string or array (one column),
+    # so it gets all three.
+    cols = []
+    for (path, t) in mapping_fields(properties, points=False):
+        leaves = [path]
+        if t == "geo_point":
+            leaves = [path + ".lat", path + ".lon", path]
+        for leaf in leaves:
+            if wanted and not wanted(leaf):
+                continue
+            if flatten:
+                cols.append(leaf.replace(".", sep))
+            else:
+                cols.append(leaf.split(".")[0])
+    return list(dict.fromkeys(cols))
+
+
+def index_properties(mapping_d, index):
+    # the top level properties from a GET <index>/_mapping response, with
+    # or without the mapping type level of older clusters
+    mappings = mapping_d.get(index, {}).get("mappings", {})
+    if "properties" in mappings :
+        return mappings["properties"]
+    for v in mappings.values() :
+        if isinstance(v, dict) and "properties" in v :
+            return v["properties"]
+    return {}
@@ -0,0 +1,183 @@
+#
+# Pooled HTTP client shared by the ES copy scripts
+#
+# Replaces forking a curl process per request.  Connections are kept
+# alive and reused, with one pool per host:port, so the local cluster
+# (9200) and every ssh tunnel port each get their own pool.
+#
+# es_run() returns the parsed JSON response.  Like curl (without -f) an
+# HTTP error status is not an error here, the ES error document is
+# returned to the caller.  Failing to talk to the server at all raises
+# BadConnection.
+#
+# A request that fails on a kept-alive connection is sent again on a new
+# one only when it can't have reached the server (it failed while being
+# sent) or when sending it twice does no harm (GET, HEAD, PUT, DELETE).
+# A POST such as _reindex or _bulk is never sent twice.
+#
+
+import json
+import select
+import threading
+import http.client
+from queue import LifoQueue, Empty, Full
+from urllib.parse import urlsplit
+
+
+# for connection errors
+class BadConnection(Exception):
+    pass
+
+
+POOL_SIZE = 16          # idle connections kept per host:port
+
+# errors from a kept-alive connection that the server already closed
+STALE_ERRORS = (http.client.RemoteDisconnected, http.client.BadStatusLine,
+                BrokenPipeError, ConnectionResetError)
+
+# methods that are safe to send again when the response was lost
+IDEMPOTENT = ("GET", "HEAD", "PUT", "DELETE")
+
+
+def dropped(conn):
+    # an idle connection the server has closed reads as ready (EOF)
+    if conn.sock is None :
+        return True
+    try:
+        return bool(select.select([conn.sock], [], [], 0)[0])
+    except (OSError, ValueError):
+        return True
+
+# end dropped
+
+
+class ESPool(object):
+    def __init__(self, host, port, size=POOL_SIZE, timeout=None):
+        self.host    = host
+        self.port    = port
+        self.timeout = timeout
+        self.idle    = LifoQueue(maxsize=size)
+
+    def _get(self):
+        while True :
+            try:
+                conn = self.idle.get_nowait()
+            except Empty:
+                return (http.client.HTTPConnection(self.host, self.port,
+                                                   timeout=self.timeout), False)
+            if not dropped(conn) :
+                return (conn, True)
+            conn.close()
+
+    def _put(self, conn):
+        try:
+            self.idle.put_nowait(conn)
+        except Full:
+            conn.close()
+
+    def request(self, method, path, body=None):
+        headers = {}
+        if body is not None :
+            if not isinstance(body, (str, bytes)) :
+                body = json.dumps(body)
+            headers["Content-Type"] = "application/json"
+
+        while True :
+            conn, reused = self._get()
+            try:
+                conn.request(method, path, body=body, headers=headers)
+            except STALE_ERRORS:
+                conn.close()
+                if reused :
+                    continue    # not sent, try again on a new connection
+                raise
+            except Exception:
+                conn.close()
+                raise
+
+            try:
+                resp = conn.getresponse()
+                data = resp.read()
+            except STALE_ERRORS:
+                conn.close()
+                # the server may have acted on it already
+                if reused and method in IDEMPOTENT :
+                    continue
+                raise
+            except Exception:
+                conn.close()
+                raise
+
+            if resp.will_close :
+                conn.close()
+            else :
+                self._put(conn)
+
+            return (resp.status, data.decode("utf-8", errors="replace"))
+
+    def close(self):
+        while True :
+            try:
+                self.idle.get_nowait().close()
+            except Empty:
+                break
+
+# end ESPool
+
+
+pools = {}
+pools_lock = threading.Lock()
+
+def get_pool(host, port):
+    with pools_lock:
+        if (host, port) not in pools :
+            pools[(host, port)] = ESPool(host, port)
+        return pools[(host, port)]
+
+# end get_pool
+
+
+def close_pool(host, port):
+    with pools_lock:
+        pool = pools.pop((host, port), None)
+    if pool :
+        pool.close()
+
+# end close_pool
+
+
+def es_run(args, method, url, body=None, text=False):
+    if args.verbose :
+        shown = body if body is not None else ""
+        if len(str(shown)) > 1000 :
+            shown = "<%d byte body>" % (len(str(shown)))
+        print("es_run: ", method, url, shown)
+
+    parts = urlsplit(url)
+    path = parts.path or "/"
+    if parts.query :
+        path = path + "?" + parts.query
+
+    pool = get_pool(parts.hostname, parts.port or 80)
+
+    try:
+        (status, data) = pool.request(method, path, body)
+    except (OSError, http.client.HTTPException) as e:
+        print("Error: es_run: unable to connect!")
+        print("   request: ", method, url)
+        print("  response: %s" % (e))
+        raise BadConnection()
+
+    if args.verbose :
+        print("  response: %d : %s" %
+              (status, data if len(data) <= 1000 else data[:1000] + " ..."))
+
+    if text :
+        return data
+
+    try:
+        return json.loads(data)
+    except ValueError:
+        return { "error": data, "status": status }
+
+# end es_run
@@ -0,0 +1,62 @@
+#
+# Index inventory for the ES copy scripts
+#
+# One _cat/indices call per cluster gives every index with its document
+# count, size, health and status.  It is kept as a dict keyed by index
+# name, so filtering, sorting and count comparisons need no further
+# requests.  Each cluster is fetched once per run.
+#
+
+import threading
+
+from es_http import es_run
+
+
+CAT_FIELDS = "index,docs.count,store.size,health,status"
+
+inventories      = {}
+inventories_lock = threading.Lock()
+
+
+def fetch_inventory(args, url):
+    cat_l = es_run(args, "GET", "%s/_cat/indices?format=json&h=%s" %
+                   ( url, CAT_FIELDS ))
+
+    if not isinstance(cat_l, list) :
+        print("Error: fetch_inventory: no index list from %s:\n  %s" %
+              (url, cat_l))
+        return {}
+
+    inventory = {}
+    for row in cat_l :
+        count = row.get("docs.count")
+        inventory[row["index"]] = {
+            "docs":   int(count) if count not in (None, "") else None,
+            "size":   row.get("store.size"),
+            "health": row.get("health"),
+            "status": row.get("status"),
+        }
+
+    return inventory
+
+# end fetch_inventory
+
+
+def get_inventory(args, url):
+    # url is the cluster, such as http://localhost:9200
+    with inventories_lock:
+        if url not in inventories :
+            inventories[url] = fetch_inventory(args, url)
+        return inventories[url]
+
+# end get_inventory
+
+
+def count_d(inventory, index):
+    # the index count in the form _count returns it, {} when not there
+    entry = inventory.get(index)
+    if entry is None or entry["docs"] is None :
+        return {}
+    return { "count": entry["docs"] }
+
+# end count_d
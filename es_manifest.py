@@ -0,0 +1,153 @@
+#
+# On-disk copy manifest for the ES copy scripts
+#
+# A SQLite file (--manifest) remembers, per host and index, the source
+# document count, when it was copied, when the counts were last seen to
+# match and the status of the last check.  Daily indexes whose date is
+# more than --settled days back and that were verified after that point
+# will not change any more, so they are skipped without any requests.
+# --reverify checks them again anyway.
+#
+
+import re
+import sqlite3
+import datetime as DT
+import threading
+from time import time
+
+
+# status values kept in the manifest
+VERIFIED = "verified"
+COPIED   = "copied"
+FAILED   = "error"
+
+# what check_copy returned : the status recorded for it; anything else
+# (missing, skipped once --num is used up) did nothing to the copy and
+# is not recorded
+RECORDED = { "exists":   VERIFIED,
+             "copied":   COPIED,
+             "recopied": COPIED,
+             "repaired": COPIED,
+             "error":    FAILED }
+
+date_re = re.compile(r'(?P<year>\d{4})[.\-](?P<month>\d{2})[.\-](?P<day>\d{2})$')
+
+manifest      = None
+manifest_lock = threading.Lock()
+
+
+def add_manifest_args(clparse):
+    clparse.add_argument('--manifest', default=None,
+                         help='SQLite file to record copied indexes in, and to skip settled ones (off)')
+    clparse.add_argument('--settled', type=int, default=7,
+                         help='with --manifest, days after which a verified daily index is no longer checked (7)')
+    clparse.add_argument('--reverify', action='store_true', default=False,
+                         help='with --manifest, check settled indexes again')
+
+# end add_manifest_args
+
+
+def open_manifest(args):
+    global manifest
+    with manifest_lock:
+        if manifest is None and args.manifest :
+            manifest = sqlite3.connect(args.manifest, check_same_thread=False)
+            manifest.execute("""CREATE TABLE IF NOT EXISTS copies (
+                                  host        TEXT,
+                                  from_index  TEXT,
+                                  to_index    TEXT,
+                                  doc_count   INTEGER,
+                                  copied_at   REAL,
+                                  verified_at REAL,
+                                  status      TEXT,
+                                  PRIMARY KEY (host, from_index, to_index))""")
+            manifest.commit()
+        return manifest
+
+# end open_manifest
+
+
+def index_date(index):
+    # epoch seconds of the day in a daily index name, or None
+    m = date_re.search(index)
+    if not m :
+        return None
+    try:
+        day = DT.datetime(int(m.group("year")), int(m.group("month")),
+                          int(m.group("day")))
+    except ValueError:
+        return None
+    return day.timestamp()
+
+# end index_date
+
+
+def lookup(args, host, from_index, to_index):
+    db = open_manifest(args)
+    if db is None :
+        return None
+    with manifest_lock:
+        row = db.execute("""SELECT doc_count, copied_at, verified_at, status
+                              FROM copies
+                             WHERE host = ? AND from_index = ? AND to_index = ?""",
+                         (host, from_index, to_index)).fetchone()
+    if row is None :
+        return None
+    return { "doc_count": row[0], "copied_at": row[1],
+             "verified_at": row[2], "status": row[3] }
+
+# end lookup
+
+
+def is_settled(args, host, from_index, to_index):
+    # the manifest record when the index can be skipped without asking
+    # either cluster, otherwise None
+    if not args.manifest or args.reverify :
+        return None
+
+    day = index_date(from_index)
+    if day is None :
+        return None
+
+    settled_at = day + 86400 * (args.settled + 1)
+    if settled_at > time() :
+        return None
+
+    rec = lookup(args, host, from_index, to_index)
+    if ( rec is None or rec["status"] != VERIFIED or
+         not rec["verified_at"] or rec["verified_at"] < settled_at ) :
+        return None
+
+    return rec
+
+# end is_settled
+
+
+def record(args, host, from_index, to_index, status, count):
+    # status is what check_copy returned
+    db = open_manifest(args)
+    if db is None or status not in RECORDED :
+        return
+
+    now = time()
+    with manifest_lock:
+        old = db.execute("""SELECT copied_at, verified_at FROM copies
+                             WHERE host = ? AND from_index = ? AND to_index = ?""",
+                         (host, from_index, to_index)).fetchone()
+        (copied_at, verified_at) = old if old else (None, None)
+
+        new_status = RECORDED[status]
+        if new_status == VERIFIED :
+            verified_at = now
+        elif new_status == COPIED :
+            copied_at   = now
+
+        db.execute("""INSERT OR REPLACE INTO copies
+                        (host, from_index, to_index, doc_count, copied_at,
+                         verified_at, status)
+                      VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                   (host, from_index, to_index, count, copied_at,
+                    verified_at, new_status))
+        db.commit()
+
+# end record
@@ -0,0 +1,236 @@
+#
+# Asynchronous reindex from a remote, used by the ES copy scripts
+#
+# Reindexes are submitted with wait_for_completion=false and the
+# resulting tasks are polled through _tasks, printing docs/sec, created,
+# failures and an ETA.
+#
+# ES can not slice a reindex from a remote, so an index is split into
+# --slices ranges of @timestamp (plus one slice for documents without
+# @timestamp) and each range is reindexed as its own task.  At most
+# --max_tasks reindex tasks run on the local cluster at any time, for
+# all hosts and indexes together.
+#
+# A slice the cluster won't start is submitted again on later polls, up
+# to SUBMIT_TRIES times; if it never starts ReindexFailed is raised once
+# the other slices are done, so the copy counts as an error.
+#
+
+import threading
+from time import time, sleep
+
+from es_http import es_run
+
+
+TIME_FIELD   = "@timestamp"
+SUBMIT_TRIES = 3                # times a slice is submitted before giving up
+
+
+# a slice of the copy never started, the destination is missing its documents
+class ReindexFailed(Exception):
+    pass
+
+
+task_slots      = None
+task_slots_lock = threading.Lock()
+
+
+def add_reindex_args(clparse):
+    clparse.add_argument('--async_reindex', action='store_true', default=False,
+                         help='submit reindexes as tasks and poll them for progress')
+    clparse.add_argument('--slices', type=int, default=1,
+                         help='with --async_reindex, split each index into this many @timestamp ranges (1)')
+    clparse.add_argument('--max_tasks', type=int, default=2,
+                         help='with --async_reindex, maximum reindex tasks running at once (2)')
+    clparse.add_argument('--poll', type=int, default=30,
+                         help='with --async_reindex, seconds between task progress checks (30)')
+
+# end add_reindex_args
+
+
+def get_task_slots(args):
+    global task_slots
+    with task_slots_lock:
+        if task_slots is None :
+            task_slots = threading.BoundedSemaphore(max(1, args.max_tasks))
+        return task_slots
+
+# end get_task_slots
+
+
+def time_slices(args, from_index):
+    # list of queries that together cover every document of from_index
+    if args.slices <= 1 :
+        return [ { "match_all": {} } ]
+
+    span_d = es_run(args, "POST",
+                    "http://localhost:%d/%s/_search" % ( args.lport, from_index ),
+                    { "size": 0,
+                      "aggs": { "min_t": { "min": { "field": TIME_FIELD } },
+                                "max_t": { "max": { "field": TIME_FIELD } } } })
+
+    try:
+        t_min = int(span_d["aggregations"]["min_t"]["value"])
+        t_max = int(span_d["aggregations"]["max_t"]["value"])
+    except (KeyError, TypeError):
+        print("    no %s range for %s, not slicing" % (TIME_FIELD, from_index))
+        return [ { "match_all": {} } ]
+
+    step = max(1, (t_max - t_min + args.slices) // args.slices)
+    queries = []
+    start = t_min
+    while start <= t_max :
+        queries.append({ "range": { TIME_FIELD: { "gte": start,
+                                                  "lt": start + step,
+                                                  "format": "epoch_millis" } } })
+        start += step
+
+    # and anything the ranges can not see
+    queries.append({ "bool": { "must_not": { "exists": { "field": TIME_FIELD } } } })
+
+    return queries
+
+# end time_slices
+
+
+def reindex_body(args, from_index, to_index, query):
+    return { "source": { "remote": { "host": "http://localhost:%d" % ( args.lport ) },
+                         "index": from_index,
+                         "query": query },
+             "dest": { "index": to_index } }
+
+# end reindex_body
+
+
+def reindex_wait(args, from_index, to_index, query):
+    # blocking reindex of the documents matching query, returns the response
+    return es_run(args, "POST", "http://localhost:9200/_reindex",
+                  reindex_body(args, from_index, to_index, query))
+
+# end reindex_wait
+
+
+def submit_reindex(args, from_index, to_index, query):
+    submit_d = es_run(args, "POST",
+                      "http://localhost:9200/_reindex?wait_for_completion=false",
+                      reindex_body(args, from_index, to_index, query))
+
+    if "task" not in submit_d :
+        print("Error: submit_reindex: reindex not started:\n  %s" % (submit_d))
+        return None
+
+    return submit_d["task"]
+
+# end submit_reindex
+
+
+def print_progress(from_index, done, total, failures, start):
+    elapsed = time() - start
+    rate = done / elapsed if elapsed > 0 else 0.0
+
+    if rate > 0 and total > done :
+        eta = "%ds" % ((total - done) / rate)
+    elif total and total <= done :
+        eta = "0s"
+    else :
+        eta = "?"
+
+    print("    %s: created %d/%d  %.0f docs/s  failures %d  ETA %s" %
+          (from_index, done, total, rate, failures, eta))
+
+# end print_progress
+
+
+def reindex_async(args, from_index, to_index, queries=None, total=None):
+    # returns the number of documents created, like curl_copy.  queries
+    # defaults to the --slices of the whole index, total (for the ETA) to
+    # the source index count
+    slots   = get_task_slots(args)
+    if queries is None :
+        queries = time_slices(args, from_index)
+    pending = [ (query, 0) for query in queries ]     # (query, tries)
+    running = {}        # task id -> last status seen
+    lost    = 0         # slices that were never started
+    created = 0
+    fail_list = []
+    start = time()
+
+    if total is None :
+        count_d = es_run(args, "GET", "http://localhost:%d/%s/_count" %
+                         ( args.lport, from_index ))
+        total = count_d.get("count", 0)
+
+    if len(pending) > 1 :
+        print("    reindexing in %d slices" % (len(pending)))
+
+    try:
+        while pending or running :
+            for task_id in list(running.keys()) :
+                task_d = es_run(args, "GET",
+                                "http://localhost:9200/_tasks/%s" % (task_id))
+
+                if "task" in task_d :
+                    running[task_id] = task_d["task"].get("status", {})
+
+                # an unknown task comes back as an error, not completed
+                if not task_d.get("completed") and "error" not in task_d :
+                    continue
+
+                del running[task_id]
+                slots.release()
+
+                result = task_d.get("response", {})
+                created += result.get("created", 0)
+                fail_list.extend(result.get("failures", []))
+                if "error" in task_d :
+                    print("Error: reindex_async: task %s failed:\n  %s" %
+                          (task_id, task_d["error"]))
+                    fail_list.append(task_d["error"])
+
+            # start as many slices as there are free task slots, the ones
+            # that don't start are tried again after the next wait
+            again = []
+            while pending and slots.acquire(blocking=False) :
+                (query, tries) = pending.pop(0)
+                task_id = submit_reindex(args, from_index, to_index, query)
+                if task_id is None :
+                    slots.release()
+                    if tries + 1 < SUBMIT_TRIES :
+                        again.append((query, tries + 1))
+                    else :
+                        print("Error: reindex_async: slice of %s not started after %d tries:\n  %s" %
+                              (from_index, SUBMIT_TRIES, query))
+                        lost += 1
+                    continue
+                running[task_id] = {}
+            pending.extend(again)
+
+            running_done = sum(st.get("created", 0) for st in running.values())
+            print_progress(from_index, created + running_done, total,
+                           len(fail_list), start)
+
+            if not pending and not running :
+                break
+
+            # also waits here for a free slot when none of ours are running
+            sleep(args.poll)
+
+    finally:
+        # tasks we stop watching keep running on the server, free their slots
+        for task_id in running :
+            slots.release()
+
+    print("    Documents Created: %d" % (created))
+
+    if len(fail_list) > 0 :
+        print("    Failures found: %d" % ( len(fail_list) ))
+        for fail in fail_list :
+            print(fail)
+
+    if lost :
+        raise ReindexFailed("%d of %d slices of %s were not copied" %
+                            (lost, len(queries), from_index))
+
+    return created
+
+# end reindex_async
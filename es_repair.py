@@ -0,0 +1,187 @@
+#
+# Bucket-level repair of a partly copied index, used by the ES copy scripts
+#
+# Instead of deleting a short destination index and copying all of it
+# again, --repair compares per time bucket document counts (a
+# date_histogram on @timestamp, --bucket wide) on both sides and
+# reindexes only the buckets that differ.  When the differing buckets
+# hold more than --repair_max of the source documents a full recopy is
+# cheaper and the caller falls back to it.
+#
+# Neighbouring buckets that differ are copied as one @timestamp range, so
+# the query stays under ES's limit on bool clauses; when there are still
+# more than MAX_RANGES ranges the index is recopied whole.
+#
+
+import re
+import argparse
+from bisect import bisect_left
+
+from es_http import es_run
+import es_reindex
+import es_stream_copy
+
+
+TIME_FIELD = es_reindex.TIME_FIELD
+NO_TIME    = "missing"          # bucket key for documents without @timestamp
+
+UNIT_MS = { "ms": 1, "s": 1000, "m": 60000, "h": 3600000, "d": 86400000 }
+MAX_RANGES = 1000               # below indices.query.bool.max_clause_count
+
+
+def add_repair_args(clparse):
+    clparse.add_argument('--repair', action='store_true', default=False,
+                         help='recopy only the @timestamp buckets that differ instead of the whole index')
+    clparse.add_argument('--bucket', default="1h", type=bucket_interval,
+                         help='with --repair, fixed date histogram interval to compare, such as 30m or 1h (1h)')
+    clparse.add_argument('--repair_max', type=float, default=0.5,
+                         help='with --repair, recopy the whole index when the differing buckets hold more than this fraction of it (0.5)')
+
+# end add_repair_args
+
+
+def bucket_counts(args, url):
+    # url is the index, returns { bucket start (epoch ms) : doc count }
+    hist_d = es_run(args, "POST", url + "/_search",
+                    { "size": 0,
+                      "aggs": { "buckets": { "date_histogram": {
+                                                 "field": TIME_FIELD,
+                                                 "fixed_interval": args.bucket,
+                                                 "min_doc_count": 1 } },
+                                "no_time": { "missing": { "field": TIME_FIELD } } } })
+
+    if "aggregations" not in hist_d :
+        print("Error: bucket_counts: no histogram for %s:\n  %s" % (url, hist_d))
+        return None
+
+    aggs = hist_d["aggregations"]
+    counts = { b["key"]: b["doc_count"] for b in aggs["buckets"]["buckets"] }
+    if aggs["no_time"]["doc_count"] > 0 :
+        counts[NO_TIME] = aggs["no_time"]["doc_count"]
+
+    return counts
+
+# end bucket_counts
+
+
+def interval_ms(interval):
+    # fixed_interval string, such as 30m or 1h, in milliseconds
+    m = re.match(r'^(\d+)(ms|s|m|h|d)$', interval)
+    if not m :
+        raise ValueError("bad --bucket interval: %s" % (interval))
+    return int(m.group(1)) * UNIT_MS[m.group(2)]
+
+# end interval_ms
+
+
+def bucket_interval(value):
+    # argparse type for --bucket, calendar units (1M, 1y) are not fixed
+    try:
+        interval_ms(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+    return value
+
+# end bucket_interval
+
+
+def merge_ranges(keys, others, width):
+    # sorted bucket starts as [start, end) ranges, neighbours joined unless
+    # a bucket from others lies between them
+    others = sorted(others)
+    ranges = []
+    for k in keys :
+        if ranges and bisect_left(others, k) == bisect_left(others, ranges[-1][1]) :
+            ranges[-1][1] = k + width
+        else :
+            ranges.append([k, k + width])
+    return ranges
+
+# end merge_ranges
+
+
+def bucket_query(key, next_key):
+    if key == NO_TIME :
+        return { "bool": { "must_not": { "exists": { "field": TIME_FIELD } } } }
+    return { "range": { TIME_FIELD: { "gte": key, "lt": next_key,
+                                      "format": "epoch_millis" } } }
+
+# end bucket_query
+
+
+def repair_copy(args, from_index, to_index, from_count):
+    # returns the number of documents created, or None when the caller
+    # should delete and recopy the whole index instead
+    from_url = "http://localhost:%d/%s" % ( args.lport, from_index )
+    to_url   = "http://localhost:9200/%s" % ( to_index )
+
+    from_b = bucket_counts(args, from_url)
+    to_b   = bucket_counts(args, to_url)
+    if from_b is None or to_b is None :
+        return None
+
+    bad = sorted((k for k in set(from_b) | set(to_b)
+                  if from_b.get(k, 0) != to_b.get(k, 0)),
+                 key=lambda k: -1 if k == NO_TIME else k)
+    bad_docs = sum(from_b.get(k, 0) for k in bad)
+
+    print("  Repairing: %d of %d %s buckets differ, %d of %d documents" %
+          (len(bad), len(from_b), args.bucket, bad_docs, from_count))
+
+    if from_count and bad_docs > args.repair_max * from_count :
+        print("    more than %d%% differs, recopying the whole index" %
+              (args.repair_max * 100))
+        return None
+
+    width = interval_ms(args.bucket)
+    keys  = set(from_b) | set(to_b)
+    timed = [k for k in bad if k != NO_TIME]
+    # documents the source does not have can only be removed
+    extra = [k for k in timed if to_b.get(k, 0) > from_b.get(k, 0)]
+
+    ranges = merge_ranges(timed, keys - set(bad) - set([NO_TIME]), width)
+    extra_ranges = merge_ranges(extra, keys - set(extra) - set([NO_TIME]), width)
+    if len(ranges) + 1 > MAX_RANGES or len(extra_ranges) + 1 > MAX_RANGES :
+        print("    %d separate ranges differ, recopying the whole index" %
+              (len(ranges)))
+        return None
+
+    queries  = [bucket_query(start, end) for (start, end) in ranges]
+    extra_qs = [bucket_query(start, end) for (start, end) in extra_ranges]
+    if NO_TIME in bad :
+        queries.insert(0, bucket_query(NO_TIME, None))
+        if to_b.get(NO_TIME, 0) > from_b.get(NO_TIME, 0) :
+            extra_qs.insert(0, bucket_query(NO_TIME, None))
+
+    if extra_qs :
+        es_run(args, "POST", to_url + "/_delete_by_query?conflicts=proceed",
+               { "query": { "bool": { "should": extra_qs,
+                                      "minimum_should_match": 1 } } })
+
+    query = { "bool": { "should": queries, "minimum_should_match": 1 } }
+
+    if args.copier == "stream" :
+        return es_stream_copy.stream_copy(args, from_index, to_index,
+                                          query=query)
+
+    if args.async_reindex :
+        return es_reindex.reindex_async(args, from_index, to_index,
+                                        queries=[query], total=bad_docs)
+
+    repair_d = es_reindex.reindex_wait(args, from_index, to_index, query)
+
+    if ( not "created" in repair_d) :
+        print("Error: repair_copy: copy failed:\n  %s" % (repair_d))
+        return 0
+
+    print("    Documents Created: %d  Updated: %d" %
+          (repair_d["created"], repair_d.get("updated", 0)))
+
+    if len(repair_d.get("failures", [])) > 0 :
+        print("    Failures found: %d" % ( len(repair_d["failures"]) ))
+        for fail in repair_d["failures"] :
+            print(fail)
+
+    return repair_d["created"]
+
+# end repair_copy
@@ -0,0 +1,142 @@
+#
+# Output sinks for es-to-fsdb.py --output
+#
+# A sink is opened with the output columns and then given one row (a
+# list of strings, in column order) at a time:
+#
+#   fsdb    tab separated FSDB, written with the csv module the way
+#           pandas to_csv quotes (the default)
+#   pyfsdb  FSDB written by pyfsdb, always with a header
+#   ndjson  one JSON object per row
+#   kafka   one JSON object per row, published to a Kafka topic in
+#           compressed batches
+#
+# In the JSON sinks the time column is a number, everything else is text.
+# The FSDB sinks write no column types, and turn tabs and line breaks in
+# values into spaces so each row stays one line of fields.
+#
+
+import csv
+import json
+
+import es_flatten
+
+try:
+    import pyfsdb
+except ImportError:
+    pyfsdb = None
+
+try:
+    from kafka import KafkaProducer
+except ImportError:
+    KafkaProducer = None
+
+
+SINKS = [ "fsdb", "pyfsdb", "ndjson", "kafka" ]
+KAFKA_LINGER = 100      # ms a batch waits to fill before it is sent
+
+
+def fsdb_value(v):
+    # one FSDB field, newlines cleaned like es_flatten.clean_str
+    if not isinstance(v, str) :
+        return v
+    return es_flatten.clean_str(v).replace('\r', '').replace('\t', ' ')
+
+# end fsdb_value
+
+
+class FsdbSink(object):
+    def __init__(self, outfile, cols, addheader):
+        self.fp = outfile
+        self.writer = csv.writer(outfile, delimiter='\t', lineterminator='\n')
+        if addheader :
+            outfile.write("#fsdb -F t %s\n" % (" ".join(cols)))
+
+    def write(self, row):
+        self.writer.writerow([ fsdb_value(v) for v in row ])
+
+    def close(self):
+        self.fp.close()
+        return True
+
+# end FsdbSink
+
+
+class PyfsdbSink(object):
+    def __init__(self, outfile, cols):
+        if pyfsdb is None :
+            raise Exception("--output pyfsdb needs the pyfsdb module")
+        # no_auto_conversion: no a:a column types, like the other sinks
+        self.db = pyfsdb.Fsdb(out_file_handle=outfile, out_column_names=cols,
+                              no_auto_conversion=True)
+
+    def write(self, row):
+        self.db.append([ fsdb_value(v) for v in row ])
+
+    def close(self):
+        # pyfsdb closes the output file too
+        self.db.close()
+        return True
+
+# end PyfsdbSink
+
+
+def json_record(cols, row, timecol):
+    rec = dict(zip(cols, row))
+    t = rec.get(timecol)
+    if isinstance(t, str) and t.lstrip("-").isdigit() :
+        rec[timecol] = int(t)
+    return rec
+
+# end json_record
+
+
+class NdjsonSink(object):
+    def __init__(self, outfile, cols, timecol):
+        self.fp = outfile
+        self.cols = cols
+        self.timecol = timecol
+
+    def write(self, row):
+        self.fp.write(json.dumps(json_record(self.cols, row, self.timecol)) + "\n")
+
+    def close(self):
+        self.fp.close()
+        return True
+
+# end NdjsonSink
+
+
+class KafkaSink(object):
+    def __init__(self, brokers, topic, cols, timecol, compression, batch):
+        if KafkaProducer is None :
+            raise Exception("--output kafka needs the kafka-python module")
+        if not topic :
+            raise Exception("--output kafka needs --topic")
+        self.topic = topic
+        self.cols = cols
+        self.timecol = timecol
+        self.failed = 0
+        self.producer = KafkaProducer(bootstrap_servers=brokers.split(","),
+                                      compression_type=None if compression == "none" else compression,
+                                      batch_size=batch, linger_ms=KAFKA_LINGER,
+                                      value_serializer=lambda x: json.dumps(x).encode('utf-8'))
+
+    def failure(self, exc):
+        if not self.failed :
+            print("Error: KafkaSink: send to %s failed: %s" % (self.topic, exc))
+        self.failed += 1
+
+    def write(self, row):
+        self.producer.send(self.topic, value=json_record(self.cols, row, self.timecol)) \
+            .add_errback(self.failure)
+
+    def close(self):
+        self.producer.flush()
+        self.producer.close()
+        if self.failed :
+            print("Error: KafkaSink: %d messages were not sent to %s" %
+                  (self.failed, self.topic))
+        return not self.failed
+
+# end KafkaSink
@@ -0,0 +1,255 @@
+#
+# Streaming scroll-to-bulk copier, used by the ES copy scripts
+#
+# An alternative to _reindex from a remote (--copier stream) that does
+# not need reindex.remote.whitelist on the destination.  The source index
+# is read over the tunnel with a sliced scroll, one reader thread per
+# slice.  Each reader hands its pages through a bounded queue to a
+# writer thread that sends them to the destination's _bulk, so a slow
+# destination holds the readers back.  Bulk requests are cut by size
+# (--bulk_mb); the size is halved whenever the destination rejects
+# documents with 429 and grows back after successful requests.
+#
+
+import json
+import threading
+from queue import Queue
+from time import time, sleep
+
+from es_http import es_run, BadConnection
+
+
+SCROLL_WAIT   = "5m"
+MIN_BULK      = 256 * 1024      # smallest bulk request size in bytes
+MAX_RETRIES   = 8               # for documents rejected with 429
+FAILURES_SHOWN = 10
+
+
+def add_stream_args(clparse):
+    clparse.add_argument('--copier', choices=["reindex", "stream"],
+                         default="reindex",
+                         help='copy with _reindex from the remote, or stream it through this host with scroll and _bulk (reindex)')
+    clparse.add_argument('--stream_slices', type=int, default=4,
+                         help='with --copier stream, scroll slices read at the same time (4)')
+    clparse.add_argument('--scroll_size', type=int, default=1000,
+                         help='with --copier stream or --dump, documents per scroll page (1000)')
+    clparse.add_argument('--bulk_mb', type=float, default=5,
+                         help='with --copier stream, largest _bulk request in MB (5)')
+    clparse.add_argument('--queue_depth', type=int, default=4,
+                         help='with --copier stream, scroll pages a slice can read ahead of its writer (4)')
+
+# end add_stream_args
+
+
+class SliceStats(object):
+    def __init__(self, slice_id):
+        self.slice_id = slice_id
+        self.docs     = 0
+        self.bytes    = 0
+        self.created  = 0
+        self.updated  = 0
+        self.bulks    = 0
+        self.failures = []
+        self.error    = None
+        self.exc      = None
+        self.start    = time()
+        self.end      = None
+
+# end SliceStats
+
+
+def read_slice(args, from_index, query, slices, q, st, halt):
+    body = { "size": args.scroll_size, "sort": [ "_doc" ], "query": query }
+    if slices > 1 :
+        body["slice"] = { "id": st.slice_id, "max": slices }
+
+    scroll_id = None
+    try:
+        res = es_run(args, "POST", "http://localhost:%d/%s/_search?scroll=%s" %
+                     ( args.lport, from_index, SCROLL_WAIT ), body)
+        while not halt.is_set() :
+            if "hits" not in res :
+                st.error = "scroll failed: %s" % (res)
+                halt.set()
+                break
+
+            scroll_id = res.get("_scroll_id", scroll_id)
+            hits = res["hits"]["hits"]
+            if not hits :
+                break
+
+            q.put(hits)     # waits while the writer is behind
+
+            res = es_run(args, "POST",
+                         "http://localhost:%d/_search/scroll" % ( args.lport ),
+                         { "scroll": SCROLL_WAIT, "scroll_id": scroll_id })
+
+    except BadConnection:
+        st.error = "connection failed"
+        halt.set()
+
+    except Exception as e:
+        # stream_copy raises it again once every thread is done
+        st.error = repr(e)
+        st.exc   = e
+        halt.set()
+
+    finally:
+        q.put(None)
+        if scroll_id :
+            try:
+                es_run(args, "DELETE",
+                       "http://localhost:%d/_search/scroll" % ( args.lport ),
+                       { "scroll_id": scroll_id })
+            except BadConnection:
+                pass
+
+# end read_slice
+
+
+def post_bulk(args, lines, st, target):
+    # sends lines (action and source pairs), retrying rejected documents;
+    # returns the bulk size to use next
+    tries = 0
+    while lines :
+        bulk_d = es_run(args, "POST", "http://localhost:9200/_bulk",
+                        "".join(lines))
+        st.bulks += 1
+
+        if "items" not in bulk_d :
+            if bulk_d.get("status") != 429 :
+                st.failures.append(bulk_d)
+                return target
+            retry = lines
+        else :
+            retry = []
+            for (n, item) in enumerate(bulk_d["items"]) :
+                result = item.get("index", {})
+                if result.get("status") == 429 :
+                    retry.extend(lines[2*n:2*n+2])
+                elif "error" in result :
+                    st.failures.append(result["error"])
+                elif result.get("result") == "created" :
+                    st.created += 1
+                else :
+                    st.updated += 1
+
+        if not retry :
+            return min(args.bulk_mb * 1024 * 1024, int(target * 1.25))
+
+        # the destination is overloaded, back off and send less at once
+        tries += 1
+        if tries > MAX_RETRIES :
+            st.failures.append("%d documents rejected after %d tries" %
+                               (len(retry) // 2, tries))
+            return target
+        target = max(MIN_BULK, target // 2)
+        sleep(min(30, 2 ** tries))
+        lines = retry
+
+    return target
+
+# end post_bulk
+
+
+def write_slice(args, to_index, q, st, halt):
+    target = int(args.bulk_mb * 1024 * 1024)
+    lines  = []
+    size   = 0
+    done   = False
+
+    try:
+        while True :
+            hits = q.get()
+            if hits is None :
+                done = True
+                break
+            if halt.is_set() :
+                continue        # keep draining so the reader is not stuck
+
+            for hit in hits :
+                action = json.dumps({ "index": { "_index": to_index,
+                                                 "_id": hit["_id"] } }) + "\n"
+                source = json.dumps(hit["_source"]) + "\n"
+                lines.extend([action, source])
+                size     += len(action) + len(source)
+                st.docs  += 1
+                st.bytes += len(action) + len(source)
+
+                if size >= target :
+                    target = post_bulk(args, lines, st, target)
+                    lines  = []
+                    size   = 0
+
+        if lines and not halt.is_set() :
+            post_bulk(args, lines, st, target)
+
+    except BadConnection:
+        st.error = "connection to localhost failed"
+        halt.set()
+
+    except Exception as e:
+        # a bad hit or bulk response, stream_copy raises it again
+        st.error = repr(e)
+        st.exc   = e
+        halt.set()
+
+    finally:
+        # keep draining so the reader is not stuck on a full queue
+        if not done :
+            while q.get() is not None :
+                pass
+        st.end = time()
+
+# end write_slice
+
+
+def stream_copy(args, from_index, to_index, query=None):
+    # returns the number of documents created, like curl_copy
+    if query is None :
+        query = { "match_all": {} }
+
+    slices = max(1, args.stream_slices)
+    halt   = threading.Event()
+    stats  = [SliceStats(i) for i in range(slices)]
+
+    threads = []
+    for st in stats :
+        q = Queue(maxsize=max(1, args.queue_depth))
+        threads.append(threading.Thread(target=read_slice,
+                                        args=(args, from_index, query,
+                                              slices, q, st, halt)))
+        threads.append(threading.Thread(target=write_slice,
+                                        args=(args, to_index, q, st, halt)))
+    for t in threads :
+        t.start()
+    for t in threads :
+        t.join()
+
+    created  = 0
+    failures = []
+    for st in stats :
+        secs = max(0.001, (st.end or time()) - st.start)
+        print("    slice %d: %d docs  %.1f MB  %d bulks  %.1f s  %.0f docs/s%s" %
+              (st.slice_id, st.docs, st.bytes / 1048576.0, st.bulks, secs,
+               st.docs / secs, "  ERROR: %s" % (st.error) if st.error else ""))
+        created += st.created
+        failures.extend(st.failures)
+
+    print("    Documents Created: %d" % (created))
+
+    if len(failures) > 0 :
+        print("    Failures found: %d" % ( len(failures) ))
+        for fail in failures[:FAILURES_SHOWN] :
+            print(fail)
+
+    for st in stats :
+        if st.exc is not None :
+            raise st.exc
+
+    if halt.is_set() and any(st.error == "connection failed" for st in stats) :
+        raise BadConnection()
+
+    return created
+
+# end stream_copy
@@ -1,15 +1,80 @@
 import sys
+import os
+import csv
+import heapq
+import pickle
+import tempfile
+import math
+import itertools
+import functools
+import multiprocessing
 import argparse
 import pandas as pd
+from pandas.api.types import union_categoricals
 import numpy as np
 import pyfsdb
 import dnssplitter
 
-splitter = dnssplitter.DNSSplitter()
-splitter.init_tree()
+# Built or loaded by load_splitter only when --pslkey is used
+splitter = None
+
+CHUNK_ROWS = 200000  # rows sorted in memory at a time by --stream
+RUN_BLOCK = 1000     # rows per pickle in a sorted run on disk
+RUN_FANIN = 64       # sorted runs merged at once; more are merged in passes first
+PSL_CACHE = 65536    # names whose PSL split --stream remembers
+PSL_PARALLEL = 50000 # distinct names before --jobs processes are used
+JOIN_PARTS = 8       # fewest partitions a join that outgrows --memory spills to
+JOIN_MAX_PARTS = 256
+JOIN_OVERHEAD = 64   # rough bytes of memory per row and per value in a join table
+TYPE_SAMPLE = 1000   # rows of each input looked at to pick its columns' types
+CATEGORY_RATIO = 0.5 # distinct/sampled values below which text is a category
+SEQ_COLUMN = " seq"   # input position a sorted join carries; never a real FSDB name (no spaces)
+PSL_TREE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "join-fsdb")
+
+def psl_tree_path(cache_dir):
+    # Named for the dnssplitter version and its PSL list, so a new list
+    # builds a new tree
+    tag = getattr(dnssplitter, "__VERSION__", "0")
+    try:
+        st = os.stat(os.path.join(os.path.dirname(dnssplitter.__file__), "domains.py"))
+        tag += "-%d-%d" % (st.st_size, int(st.st_mtime))
+    except OSError:
+        pass
+    return os.path.join(cache_dir, "psl-tree-%s.pickle" % (tag))
+
+def load_splitter(cache_dir=PSL_TREE_DIR):
+    # The PSL tree from cache_dir when an earlier run saved it there,
+    # otherwise built and saved for the next run
+    global splitter
+    if splitter is not None:
+        return splitter
+    splitter = dnssplitter.DNSSplitter()
+    path = psl_tree_path(cache_dir) if cache_dir else None
+    if path:
+        try:
+            with open(path, "rb") as f:
+                splitter.tree = pickle.load(f)
+            return splitter
+        except Exception:
+            pass
+    splitter.init_tree()
+    if path:
+        tmp = None
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(suffix=".tmp", dir=cache_dir)
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(splitter.tree, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, path)
+        except OSError:
+            if tmp and os.path.exists(tmp):
+                os.remove(tmp)
+    return splitter
 
 def get_psl(x):
-    noval = [np.NaN, np.NaN, np.NaN]
+    noval = [np.nan, np.nan, np.nan]
+    if splitter is None:
+        load_splitter()
     try:
         ret = splitter.search_tree(x)
         if not ret or len(ret) != 3:
@@ -18,6 +83,486 @@ def get_psl(x):
     except:
         return noval
 
+@functools.lru_cache(maxsize=PSL_CACHE)
+def cached_psl(x):
+    return tuple(get_psl(x))
+
+def psl_split(df, keys, jobs):
+    # get_psl once per distinct name across all the keys' columns, in
+    # jobs processes when there are many, then spread back to the rows.
+    # Returns an (rows, 3) object array per key.
+    n = len(df)
+    codes, names = pd.factorize(pd.concat([df[k] for k in keys], ignore_index=True))
+    if jobs > 1 and len(names) > PSL_PARALLEL:
+        with multiprocessing.Pool(jobs) as pool:
+            splits = pool.map(get_psl, names, chunksize=max(1, len(names) // (jobs * 4)))
+    else:
+        splits = [get_psl(x) for x in names]
+    # the last row is for missing values, whose code is -1
+    table = np.empty((len(names) + 1, 3), dtype=object)
+    for (i, v) in enumerate(splits):
+        table[i] = v
+    table[-1] = get_psl(None)
+    return [table[codes[i * n:(i + 1) * n]] for i in range(len(keys))]
+
+def psl_values(row, pslidx, merged):
+    # The PSL columns for one row, as main adds them: three per --pslkey
+    # and, with --pslmerged, the last value found for each of the three
+    out = []
+    cons = [None, None, None]
+    for i in pslidx:
+        vals = cached_psl(row[i] if i is not None else "")
+        vals = [v if isinstance(v, str) else None for v in vals]
+        out.extend(vals)
+        cons = [v if v is not None else c for (v, c) in zip(vals, cons)]
+    if merged:
+        out.extend(cons)
+    return out
+
+def number(v):
+    # v as a number for --numeric, None when it isn't one
+    if v is None or isinstance(v, float):
+        return v if v == v else None
+    try:
+        return int(v)
+    except ValueError:
+        pass
+    try:
+        x = float(v)
+    except ValueError:
+        return None
+    return x if x == x else None
+
+def row_key(cols, sortkey, numeric=False):
+    # Sorts like sort_values on the string column, rows without it last.
+    # Values from typed headers (ints, floats) compare as their text, or
+    # with numeric by value, anything that isn't a number last.
+    idx = cols.index(sortkey) if sortkey in cols else None
+    def key(row):
+        if idx is None or row[idx] is None:
+            return (1, "")
+        return (0, str(row[idx]))
+    def numeric_key(row):
+        x = number(row[idx]) if idx is not None else None
+        if x is None:
+            return (1, 0)
+        return (0, x)
+    return numeric_key if numeric else key
+
+def sort_numbers(col):
+    # sort_values key for --numeric, the same order as row_key's
+    if pd.api.types.is_numeric_dtype(col.dtype):
+        return col
+    return col.astype(object).map(number)
+
+def is_sorted(fp, sortkey, numeric=False):
+    # Whether an input file is already in --sortkey order, read through
+    # its own handle; inputs that can't be read twice are not
+    if not os.path.isfile(fp.name):
+        return False
+    db = pyfsdb.Fsdb(filename=fp.name)
+    key = row_key(db.column_names, sortkey, numeric)
+    last = None
+    for row in db:
+        k = key(row)
+        if last is not None and k < last:
+            return False
+        last = k
+    return True
+
+def read_run(path):
+    with open(path, "rb") as f:
+        while True:
+            try:
+                block = pickle.load(f)
+            except EOFError:
+                break
+            yield from block
+
+def write_run(rows, tmpdir):
+    fd, path = tempfile.mkstemp(suffix=".run", dir=tmpdir)
+    rows = iter(rows)
+    with os.fdopen(fd, "wb") as f:
+        while True:
+            block = list(itertools.islice(rows, RUN_BLOCK))
+            if not block:
+                break
+            pickle.dump(block, f, pickle.HIGHEST_PROTOCOL)
+    return path
+
+def sorted_runs(db, key, tmpdir, chunk):
+    # Chunked external sort: each chunk of rows is sorted and written to
+    # disk as a run, and the runs are read back for the merge
+    paths = []
+    rows = iter(db)
+    while True:
+        block = list(itertools.islice(rows, chunk))
+        if not block:
+            break
+        block.sort(key=key)
+        paths.append(write_run(block, tmpdir))
+
+    # A run is an open file during the merge: past RUN_FANIN, neighbouring
+    # runs are merged into longer ones first, in order so ties stay in order
+    while len(paths) > RUN_FANIN:
+        merged = []
+        for i in range(0, len(paths), RUN_FANIN):
+            group = paths[i:i + RUN_FANIN]
+            if len(group) == 1:
+                merged.append(group[0])
+                continue
+            merged.append(write_run(heapq.merge(*[read_run(p) for p in group], key=key), tmpdir))
+            for p in group:
+                os.remove(p)
+        paths = merged
+    return [read_run(p) for p in paths]
+
+def remap(rows, cols, allcols):
+    # Rows in an input's columns to rows in the output's, None (written
+    # as "", sorted last) where the input doesn't have a column
+    pos = [allcols.index(c) for c in cols]
+    width = len(allcols)
+    for row in rows:
+        out = [None] * width
+        for (i, v) in zip(pos, row):
+            out[i] = v
+        yield out
+
+def union_columns(dbs, sortkey):
+    # Every input's columns in the order first seen, sortkey first
+    allcols = []
+    for db in dbs:
+        for c in db.column_names:
+            if c not in allcols:
+                allcols.append(c)
+    if sortkey in allcols:
+        allcols.remove(sortkey)
+        allcols.insert(0, sortkey)
+    return allcols
+
+def write_rows(p, allcols, rows):
+    # Writes rows as FSDB, adding the --pslkey columns to each
+    pslidx = [allcols.index(k) if k in allcols else None for k in p.pslkey or []]
+    cols = list(allcols)
+    if p.pslkey:
+        pslcols = ["_pslpfx", "_psldom", "_pslpub"]
+        for k in p.pslkey:
+            cols.extend([k+c for c in pslcols])
+        if p.pslmerged:
+            cols.extend(pslcols)
+
+    if p.addheader:
+        p.outfile.write("#fsdb -F t %s\n" % (" ".join(cols)))
+    # the csv module quotes like to_csv
+    writer = csv.writer(p.outfile, delimiter='\t', lineterminator='\n')
+    for row in rows:
+        if pslidx:
+            row.extend(psl_values(row, pslidx, p.pslmerged))
+        writer.writerow(row)
+
+def stream_join(p):
+    # Writes the inputs row by row: merged on --sortkey when given, each
+    # input read as it is when already sorted and through an external
+    # sort otherwise, or one after the other without --sortkey
+    dbs = [pyfsdb.Fsdb(file_handle=fp) for fp in p.infile]
+    allcols = union_columns(dbs, p.sortkey)
+
+    with tempfile.TemporaryDirectory(prefix="join-fsdb-") as tmpdir:
+        sources = []
+        for (fp, db) in zip(p.infile, dbs):
+            cols = db.column_names
+            if not p.sortkey:
+                sources.append(remap(db, cols, allcols))
+            elif is_sorted(fp, p.sortkey, p.numeric):
+                sources.append(remap(db, cols, allcols))
+            else:
+                for run in sorted_runs(db, row_key(cols, p.sortkey, p.numeric), tmpdir, p.chunk):
+                    sources.append(remap(run, cols, allcols))
+
+        if p.sortkey:
+            rows = heapq.merge(*sources, key=row_key(allcols, p.sortkey, p.numeric))
+        else:
+            rows = itertools.chain(*sources)
+        write_rows(p, allcols, rows)
+
+def join_keys(on, lcols, rcols, name):
+    # --on col or left=right, as column numbers on each side
+    lk = []
+    rk = []
+    for o in on:
+        (lname, _, rname) = o.partition("=")
+        rname = rname or lname
+        if lname not in lcols:
+            sys.exit("join-fsdb: --on %s: no column %s in the inputs" % (o, lname))
+        if rname not in rcols:
+            sys.exit("join-fsdb: --on %s: no column %s in %s" % (o, rname, name))
+        lk.append(lcols.index(lname))
+        rk.append(rcols.index(rname))
+    return (lk, rk)
+
+def join_key(row, idx):
+    # The key columns as text, so a typed header's 1 matches an untyped
+    # "1"; an empty string is a missing value
+    return tuple("" if row[i] is None else str(row[i]) for i in idx)
+
+def row_bytes(row):
+    return JOIN_OVERHEAD + sum(JOIN_OVERHEAD + len(str(v)) for v in row if v is not None)
+
+def probe(left, lk, table, width, how):
+    # Each left row with every right row sharing its key, or with empty
+    # right columns for a left join when there is none
+    empty = [None] * width
+    for row in left:
+        matches = table.get(join_key(row, lk))
+        if matches:
+            for vals in matches:
+                yield row + vals
+        elif how == "left":
+            yield row + empty
+
+class Partitions(object):
+    # Rows spread over parts files on disk by the hash of their key
+    def __init__(self, parts, tmpdir):
+        self.paths = []
+        self.files = []
+        for i in range(parts):
+            fd, path = tempfile.mkstemp(suffix=".part", dir=tmpdir)
+            self.paths.append(path)
+            self.files.append(os.fdopen(fd, "wb"))
+        self.blocks = [[] for i in range(parts)]
+
+    def add(self, key, item):
+        n = hash(key) % len(self.files)
+        self.blocks[n].append(item)
+        if len(self.blocks[n]) >= RUN_BLOCK:
+            pickle.dump(self.blocks[n], self.files[n], pickle.HIGHEST_PROTOCOL)
+            self.blocks[n] = []
+
+    def close(self):
+        for (f, block) in zip(self.files, self.blocks):
+            if block:
+                pickle.dump(block, f, pickle.HIGHEST_PROTOCOL)
+            f.close()
+        return self.paths
+
+def grace_join(left, lk, table, rest, rk, keep, how, parts, tmpdir):
+    # The right side outgrew --memory: both sides are split into parts
+    # partitions by key on disk, and each pair joined in memory
+    right = Partitions(parts, tmpdir)
+    for (key, matches) in table.items():
+        for vals in matches:
+            right.add(key, (key, vals))
+    table.clear()
+    for row in rest:
+        key = join_key(row, rk)
+        if all(key):
+            right.add(key, (key, [row[i] for i in keep]))
+    rpaths = right.close()
+
+    lparts = Partitions(parts, tmpdir)
+    for row in left:
+        key = join_key(row, lk)
+        if all(key):
+            lparts.add(key, row)
+        elif how == "left":
+            yield row + [None] * len(keep)
+    lpaths = lparts.close()
+
+    for (rpath, lpath) in zip(rpaths, lpaths):
+        part = {}
+        for (key, vals) in read_run(rpath):
+            part.setdefault(key, []).append(vals)
+        yield from probe(read_run(lpath), lk, part, len(keep), how)
+        os.remove(rpath)
+        os.remove(lpath)
+
+def join_input(left, lcols, fp, p, n, tmpdir):
+    # Joins the rows of left to the -J input fp on --on.  Returns the
+    # joined columns and rows; right columns already in lcols get _n.
+    db = pyfsdb.Fsdb(file_handle=fp)
+    rcols = db.column_names
+    (lk, rk) = join_keys(p.on, lcols, rcols, fp.name)
+    keep = [i for i in range(len(rcols)) if i not in rk]
+    cols = lcols + [rcols[i] if rcols[i] not in lcols else "%s_%d" % (rcols[i], n)
+                    for i in keep]
+
+    # A table of the right side, for as long as it fits; empty keys
+    # never match
+    budget = int(p.memory * 1024 * 1024)
+    table = {}
+    used = 0
+    size = 0
+    rows = iter(db)
+    for row in rows:
+        key = join_key(row, rk)
+        if not all(key):
+            continue
+        table.setdefault(key, []).append([row[i] for i in keep])
+        used += row_bytes(row)
+        size += sum(len(str(v)) + 1 for v in row if v is not None) + 1
+        if used > budget:
+            # enough partitions for each to fit, going by the file size
+            total = used * 4
+            if os.path.isfile(fp.name):
+                total = used * os.path.getsize(fp.name) / size
+            parts = min(JOIN_MAX_PARTS, max(JOIN_PARTS, int(math.ceil(2 * total / max(budget, 1)))))
+            return (cols, grace_join(left, lk, table, rows, rk, keep, p.how, parts, tmpdir))
+    return (cols, probe(left, lk, table, len(keep), p.how))
+
+def keyed_join(p):
+    # The --infile rows, one input after another, joined to each --join
+    # input in turn, then sorted on disk if --sortkey is given
+    dbs = [pyfsdb.Fsdb(file_handle=fp) for fp in p.infile]
+    cols = union_columns(dbs, None)
+
+    with tempfile.TemporaryDirectory(prefix="join-fsdb-") as tmpdir:
+        rows = itertools.chain(*[remap(db, db.column_names, cols) for db in dbs])
+        sorting = p.sortkey in cols
+        if sorting:
+            # input position, so rows with equal sort keys come out in the
+            # same order whether or not the join spilled to disk
+            rows = (r + [n] for (n, r) in enumerate(rows))
+            cols = cols + [SEQ_COLUMN]
+        for (n, fp) in enumerate(p.join, 2):
+            (cols, rows) = join_input(rows, cols, fp, p, n, tmpdir)
+
+        if sorting:
+            seq = cols.index(SEQ_COLUMN)
+            order = [cols.index(p.sortkey)] + [i for (i, c) in enumerate(cols) if c not in (p.sortkey, SEQ_COLUMN)]
+            key = row_key(cols, p.sortkey, p.numeric)
+            ranked = lambda r: (key(r), r[seq])
+            rows = heapq.merge(*sorted_runs(rows, ranked, tmpdir, p.chunk), key=ranked)
+            cols = [cols[i] for i in order]
+            rows = ([r[i] for i in order] for r in rows)
+        write_rows(p, cols, rows)
+
+def column_type(values, converter):
+    # int, float, category or text: from the FSDB header's type when it
+    # has one, else from a sample of the column's values
+    if converter is int:
+        return "int"
+    if converter is float:
+        return "float"
+    if converter is not None and converter is not str:
+        return "text"
+    vals = [v for v in values if v]
+    if not vals:
+        return "text"
+    for (kind, conv) in (("int", int), ("float", float)):
+        try:
+            if all(v == number_text(conv(v)) for v in vals):
+                return kind
+        except ValueError:
+            pass
+    if len(set(vals)) <= CATEGORY_RATIO * len(values):
+        return "category"
+    return "text"
+
+def number_text(x):
+    # x as to_csv writes it; NaN and inf never round trip
+    if isinstance(x, float) and not np.isfinite(x):
+        return None
+    return str(x)
+
+def typed_column(values, kind):
+    # values as an array of kind, or None when a value would not be
+    # written back exactly as it was read.  Empty values are missing.
+    if kind == "category":
+        return pd.Categorical(values)
+    if kind == "text":
+        return np.array(values, dtype=object)
+    vals = pd.Series(values, dtype=object)
+    missing = vals.isna() | (vals == "")
+    dtype = np.int64 if kind == "int" else np.float64
+    try:
+        nums = vals[~missing].astype(dtype)
+    except (ValueError, TypeError, OverflowError):
+        return None
+    if not (nums.values.astype(str) == vals[~missing].values.astype(str)).all():
+        return None
+    if not missing.any():
+        return nums.values
+    out = missing_column(kind, len(vals))
+    out[~missing.values] = nums.values
+    return out
+
+def as_text(column):
+    # a typed column back as the strings it was read from
+    vals = pd.Series(column)
+    return np.where(vals.isna(), None, vals.astype(str).values).astype(object)
+
+def missing_column(kind, n):
+    if kind == "int":
+        return pd.array([pd.NA] * n, dtype="Int64")
+    if kind == "float":
+        return np.full(n, np.nan)
+    return np.full(n, np.nan, dtype=object)
+
+def load_frame(p):
+    # The inputs as one DataFrame with a compact type per column: int64
+    # and float64 for numbers, categories for text with few distinct
+    # values, and object arrays only for the rest.  Each input is read
+    # --chunk rows at a time; a column whose values stop fitting its
+    # type goes back to text.
+    dbs = [pyfsdb.Fsdb(file_handle=fp) for fp in p.infile]
+    cols = union_columns(dbs, None)
+    kinds = {}
+    # --sortkey sorts as text unless --numeric
+    for k in (p.pslkey or []) + ([p.sortkey] if p.sortkey and not p.numeric else []):
+        kinds[k] = "text"
+    parts = dict((c, []) for c in cols)
+    total = 0
+    for db in dbs:
+        names = db.column_names
+        converters = db.converters or []
+        if isinstance(converters, dict):
+            converters = [converters.get(c) for c in names]
+        rows = iter(db)
+        while True:
+            chunk = list(itertools.islice(rows, p.chunk))
+            if not chunk:
+                break
+            total += len(chunk)
+            values = list(zip(*chunk))
+            for (n, c) in enumerate(names):
+                if p.text:
+                    kinds[c] = "text"
+                elif c not in kinds:
+                    conv = converters[n] if n < len(converters) else None
+                    kinds[c] = column_type(values[n][:TYPE_SAMPLE], conv)
+                if kinds[c] == "text" and n < len(converters) and converters[n] in (int, float):
+                    # a typed header's numbers as their text, to sort as text
+                    values[n] = [None if v is None else str(v) for v in values[n]]
+                column = typed_column(values[n], kinds[c])
+                if column is None:
+                    kinds[c] = "text"
+                    parts[c] = [part if isinstance(part, int) else as_text(part) for part in parts[c]]
+                    column = typed_column(values[n], "text")
+                parts[c].append(column)
+            for c in cols:
+                if c not in names:
+                    parts[c].append(len(chunk))
+
+    df = pd.DataFrame(index=pd.RangeIndex(total))
+    for c in cols:
+        kind = kinds.get(c, "text")
+        if not total:
+            df[c] = missing_column("text", 0)
+            continue
+        if kind == "category":
+            # placeholders share the categories' dtype, or union fails
+            cats = [part.categories for part in parts[c] if not isinstance(part, int)][0][:0]
+            column = [pd.Categorical([None] * part, categories=cats) if isinstance(part, int) else part
+                      for part in parts[c]]
+        else:
+            column = [missing_column(kind, part) if isinstance(part, int) else part for part in parts[c]]
+        parts[c] = None
+        if kind == "category":
+            df[c] = union_categoricals(column, sort_categories=True)
+        else:
+            df[c] = pd.concat([pd.Series(part) for part in column], ignore_index=True)
+    return df
+
 def main(argv):
     parser = argparse.ArgumentParser()
     parser.add_argument("-i", "--infile", help="Input file",
@@ -27,24 +572,40 @@ def main(argv):
     parser.add_argument("-H", "--addheader", help="Add FSDB header", action="store_true")
     parser.add_argument("-p", "--pslkey", help="Split PSL key", type=str, action="append", default=None)
     parser.add_argument("-M", "--pslmerged", help="Make merged psl columns", action="store_true")
+    parser.add_argument("-S", "--stream", help="Merge the inputs on --sortkey row by row in constant memory, sorting unsorted inputs in chunks on disk", action="store_true")
+    parser.add_argument("-c", "--chunk", help="Rows per chunk when --stream sorts an input or an input is loaded (default=%d)" % (CHUNK_ROWS), type=int, default=CHUNK_ROWS)
+    parser.add_argument("-j", "--jobs", help="Processes to split PSL keys in when there are more than %d distinct names (default=1)" % (PSL_PARALLEL), type=int, default=1)
+    parser.add_argument("-C", "--pslcache", help="Directory to keep the built PSL tree in, '' to build it every run (default=%s)" % (PSL_TREE_DIR), type=str, default=PSL_TREE_DIR)
+    parser.add_argument("-n", "--numeric", help="Sort --sortkey by numeric value, values that aren't numbers last, instead of as text", action="store_true")
+    parser.add_argument("-t", "--text", help="Load every column as text instead of picking compact types", action="store_true")
+    parser.add_argument("-J", "--join", help="Join the inputs' rows to the rows of this file with the same --on key", type=argparse.FileType('r'), action="append", default=None)
+    parser.add_argument("-k", "--on", help="Key column for --join, or left=right when the names differ", type=str, action="append", default=None)
+    parser.add_argument("-w", "--how", help="inner: only rows with a match, left: all input rows (default=inner)", choices=["inner", "left"], default="inner")
+    parser.add_argument("-m", "--memory", help="MB of --join rows held in memory before spilling partitions to disk (default=512)", type=float, default=512)
     p = parser.parse_args(argv)
 
-    # create empty dataframe
-    df = pd.DataFrame()
+    if p.join and not p.on:
+        parser.error("--join needs --on")
+
+    if p.pslkey:
+        load_splitter(p.pslcache)
 
-    # Process each file and add to dataframe
-    for fp in p.infile:
-        db = pyfsdb.Fsdb(file_handle=fp)
-        rows = [r for r in db]
-        data = np.array(rows)
-        dfp = pd.DataFrame(data=data, columns=db.column_names)
-        df = pd.concat([df,dfp], ignore_index=True)
+    if p.join:
+        keyed_join(p)
+        return
+
+    if p.stream:
+        stream_join(p)
+        return
+
+    df = load_frame(p)
 
     cols = list(df.columns)
 
     # Sort dataframe
     if p.sortkey:
-        df.sort_values(by=[p.sortkey], inplace=True)
+        df.sort_values(by=[p.sortkey], inplace=True, kind="stable",
+                       key=sort_numbers if p.numeric else None)
         # Move sortkey to first col
         if p.sortkey in cols:
             cols.remove(p.sortkey)
@@ -54,22 +615,19 @@ def main(argv):
     # Add psl where needed
     if p.pslkey:
         pslcols = ["_pslpfx", "_psldom", "_pslpub"]
-        dfncons = pd.DataFrame(columns=pslcols)
-        for k in p.pslkey:
-            vals = df[k].apply(lambda x: get_psl(x))
-            dfn = vals.to_frame()
-            listvals = dfn[k].values.tolist()
-            dfn_split = pd.DataFrame(listvals, index=dfn.index, columns=pslcols)
+        cons = None
+        for (k, split) in zip(p.pslkey, psl_split(df, p.pslkey, p.jobs)):
             newcols = [k+c for c in pslcols]
-            df[newcols] = dfn_split
+            df[newcols] = split
             cols.extend(newcols)
-            # Create a merged dataframe
-            if dfncons.empty:
-                dfncons = dfn_split
+            # Merged columns take each key's values where it has them
+            if cons is None:
+                cons = split.copy()
             else:
-                dfncons.update(dfn_split, overwrite=True)
+                found = pd.notna(split)
+                cons[found] = split[found]
         if p.pslmerged:
-            df[pslcols] = dfncons
+            df[pslcols] = cons
             cols.extend(pslcols)
 
     # Write dataframe as fsdb
@@ -0,0 +1,58 @@
+#
+# Date math and rounding in es_daterange.parse_bound: a bound may come
+# out wider than ES reads it, never narrower
+#
+
+import os
+import sys
+from datetime import date, datetime, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import es_daterange
+
+NOW = datetime(2021, 3, 1, 12, 30, tzinfo=timezone.utc)
+
+
+def bound(value, upper):
+    return es_daterange.parse_bound(value, upper, now=NOW)
+
+
+def test_subtract_months_upper():
+    assert bound("now-1M", True) == datetime(2021, 2, 1, 12, 30, tzinfo=timezone.utc)
+    days = es_daterange.range_days({"gte": "now-2M", "lte": "now-1M"}, now=NOW)
+    assert days == (date(2021, 1, 1), date(2021, 2, 1))
+
+
+def test_add_months_lower():
+    assert bound("2021-02-01||+1M", False).date() == date(2021, 3, 1)
+    assert bound("2021-01-31||+1M", False).date() == date(2021, 2, 28)
+
+
+def test_years_both_ways():
+    assert bound("2021-03-01||-1y", True).date() == date(2020, 3, 1)
+    assert bound("2020-02-29||+1y", False).date() == date(2021, 2, 28)
+    assert bound("now+1y", True).date() == date(2022, 3, 1)
+
+
+def test_fixed_units():
+    assert bound("now-1w", False).date() == date(2021, 2, 22)
+    assert bound("now+36h", True) == datetime(2021, 3, 3, 0, 30, tzinfo=timezone.utc)
+
+
+def test_rounding_widens():
+    assert bound("now/d", False) == datetime(2021, 3, 1, tzinfo=timezone.utc)
+    assert bound("now/d", True) == datetime(2021, 3, 1, 23, 59, 59, 999000, tzinfo=timezone.utc)
+    assert bound("now-1M/M", False) == datetime(2021, 2, 1, tzinfo=timezone.utc)
+    assert bound("now-1M/M", True).date() == date(2021, 2, 28)
+    assert bound("now/y", True).date() == date(2021, 12, 31)
+    assert bound("now/w", False).date() == date(2021, 3, 1)
+    assert bound("now/w", True).date() == date(2021, 3, 7)
+
+
+def test_daily_indices_kept():
+    names = ["logstash-2021.01.%02d" % d for d in range(25, 32)] + \
+            ["logstash-2021.02.%02d" % d for d in range(1, 29)]
+    (first, last) = es_daterange.range_days({"gte": "now-2M", "lte": "now-1M"}, now=NOW)
+    wanted = es_daterange.daily_indices(names, es_daterange.DAILY_PATTERN, first, last)
+    assert wanted == ["logstash-2021.01.*", "logstash-2021.02.01"]
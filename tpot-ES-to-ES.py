@@ -4,17 +4,21 @@ import datetime as DT
 import dateutil.parser as DP
 import re
 import argparse
-from subprocess import run, check_call, CalledProcessError, PIPE
+from subprocess import run
 import random
 from math import floor
 import json
-import sys
 
 from time import sleep
 
-# for curl connection errors
-class BadConnection(Exception):
-    pass
+import es_copy_pool
+import es_reindex
+import es_repair
+import es_manifest
+import es_inventory
+import es_bulkload
+import es_stream_copy
+from es_http import es_run, close_pool
 
 
 line_re = re.compile(
@@ -55,33 +59,8 @@ def close_ssh_tunnel(args, control_path, tp):
 # end close_ssh_tunnel
 
 
-def curl_run(args, cmd_str):
-    if args.verbose :
-        print("curl_run: ", cmd_str)
-
-    try:
-        run_ret = run(args=cmd_str, check=True, stdout=PIPE, stderr=PIPE)
-    except CalledProcessError as cpe:
-        print("Error: curl_run: unable to connect with curl!")
-        print("   command: ", cmd_str)
-        print("  response: %d\n  %s\n  %s" %
-              (cpe.returncode, cpe.stdout, cpe.stderr))
-        raise BadConnection()
-
-    if args.verbose :
-        print("  response: %s : %s" %
-              (run_ret.stdout, run_ret.stderr))
-
-    return run_ret
-
-# end curl_run
-
-
 def curl_delete_to(args, to_index):
-    cmd_del_to  = ("curl", "-X", "DELETE", "http://localhost:9200/%s/" %
-                   ( to_index ))
-    
-    curl_delete_to = curl_run(args, cmd_del_to)
+    es_run(args, "DELETE", "http://localhost:9200/%s/" % ( to_index ))
 
 # end curl_delete_to
 
@@ -89,79 +68,150 @@ def curl_delete_to(args, to_index):
 def curl_copy(args, from_index, to_index):
     # prepare the TO index
     # create index
-    cmd_create =  ("curl", "-X", "PUT",
-                   "http://localhost:9200/%s" % ( to_index ))
-    
     # Not checking resposne, Errors should be caught during copy
-    curl_run(args, cmd_create)
+    es_run(args, "PUT", "http://localhost:9200/%s" % ( to_index ))
     
     # change total_fields limit from ES default 1000 to TPOT s/w's 2000
-    cmd_add = ("curl", "-X", "PUT", 
-               "http://localhost:9200/%s/_settings" % ( to_index ),
-               "-H", "Content-Type: application/json", "-d",
-               "{ \"index.mapping.total_fields.limit\": 2000 }")
-
     # Not checking response, Errors should be caught during copy
-    curl_run(args, cmd_add)
+    es_run(args, "PUT", "http://localhost:9200/%s/_settings" % ( to_index ),
+           { "index.mapping.total_fields.limit": 2000 })
     
-    cmd = ("curl", "-X", "POST", "http://localhost:9200/_reindex?pretty", "-H", "Content-Type: application/json", "-d", "{ \"source\": { \"remote\": { \"host\": \"http://localhost:%d\" }, \"index\": \"%s\", \"query\": { \"match_all\": {} } }, \"dest\": { \"index\": \"%s\" } }" % ( args.lport, from_index, to_index ) )
+    saved = es_bulkload.prepare(args, to_index)
+
+    try:
+        created = curl_reindex(args, from_index, to_index)
+    except Exception:
+        # put the index settings back even though the copy stopped
+        es_bulkload.finish(args, from_index, to_index, saved, False)
+        raise
+
+    es_bulkload.finish(args, from_index, to_index, saved, True)
+
+    return created
     
-    curl_copy_run = curl_run(args, cmd)
+# end curl_copy
+
 
-    curl_copy_d = json.loads(curl_copy_run.stdout)
+def curl_reindex(args, from_index, to_index):
+    if args.copier == "stream" :
+        return es_stream_copy.stream_copy(args, from_index, to_index)
 
+    if args.async_reindex :
+        return es_reindex.reindex_async(args, from_index, to_index)
+
+    curl_copy_d = es_run(args, "POST", "http://localhost:9200/_reindex",
+                         { "source": { "remote": { "host": "http://localhost:%d" % ( args.lport ) },
+                                       "index": from_index,
+                                       "query": { "match_all": {} } },
+                           "dest": { "index": to_index } })
+
+    created = 0
     if ( not "created" in curl_copy_d) :
-        print("Error: curl_copy: copy failed:\n  %s" % (curl_copy_run.stdout))
+        print("Error: curl_copy: copy failed:\n  %s" % (json.dumps(curl_copy_d)))
     else :
-        print("    Documents Created: %d" % (curl_copy_d["created"]))
+        created = curl_copy_d["created"]
+        print("    Documents Created: %d" % (created))
 
     if ( ( "failures" in curl_copy_d ) and 
          ( len(curl_copy_d["failures"]) > 0 ) )  :
         print("    Failures found: %d" % ( len(curl_copy_d["failures"]) ))
         for fail in curl_copy_d["failures"] :
             print(fail)
+
+    return created
     
-# end curl_copy
+# end curl_reindex
 
 
 
-def curl_check_copy(args, from_index, to_index):
-    cmd_to   = ("curl", "-X", "GET", "http://localhost:9200/%s/_count" %
-                ( to_index ) )
-    
-    cmd_from = ("curl", "-X", "GET", "http://localhost:%d/%s/_count" %
-                ( args.lport, from_index ) )
-    
-    run_to   = curl_run(args, cmd_to)
-    run_from = curl_run(args, cmd_from)
+def curl_check_copy(args, from_index, to_index, from_inv=None, to_inv=None):
+    if from_inv is not None :
+        run_from_d = es_inventory.count_d(from_inv, from_index)
+        run_to_d   = es_inventory.count_d(to_inv, to_index)
 
-    run_to_d   = json.loads(run_to.stdout)
-    run_from_d = json.loads(run_from.stdout)
+    # _cat counts nested documents too and can lag a refresh, so a
+    # mismatch is confirmed with _count before acting on it
+    if ( from_inv is None or
+         ( "count" in run_from_d and "count" in run_to_d and
+           run_from_d["count"] != run_to_d["count"] ) ) :
+        run_to_d   = es_run(args, "GET", "http://localhost:9200/%s/_count" %
+                            ( to_index ))
+        run_from_d = es_run(args, "GET", "http://localhost:%d/%s/_count" %
+                            ( args.lport, from_index ))
         
     if ( not "count" in run_from_d ) :
         print("  Index Not Found: Skipping: \'%s\'\n" %
               (from_index))
+        return ("missing", 0, 0)
     elif ( not "count" in run_to_d ) :
         print("  Copying:  %s:%d" %  (from_index, run_from_d["count"]))
-        curl_copy(args, from_index, to_index)
+        return ("copied", curl_copy(args, from_index, to_index),
+                run_from_d["count"])
     elif ( run_from_d["count"] == run_to_d["count"] ) :
         print("  Exists already: Skipping: %d == %s:%d" %
               (run_from_d["count"], to_index, run_to_d["count"]))
+        return ("exists", 0, run_from_d["count"])
     elif ( run_from_d["count"] > run_to_d["count"] ) :
+        if args.repair :
+            repaired = es_repair.repair_copy(args, from_index, to_index,
+                                             run_from_d["count"])
+            if repaired is not None :
+                return ("repaired", repaired, run_from_d["count"])
         print("  Deleting and Copying: document sizes do not match:")
         print("    %s:%d > %s:%d" %
               (from_index, run_from_d["count"],
                to_index, run_to_d["count"]))
         curl_delete_to(args, to_index)
-        curl_copy(args, from_index, to_index)
+        return ("recopied", curl_copy(args, from_index, to_index),
+                run_from_d["count"])
     else :
         print("ERROR: nuts!, should not happen: %s:%d < %s:%d" %
               (from_index, run_from_d["count"],
                to_index,   run_to_d["count"]))
+        return ("error", 0, run_from_d["count"])
 
 # end curl_check_copy
 
 
+def copy_host(args, tp, stats):
+    pairs = []
+    wh_dt = start_dt
+    while wh_dt <= end_dt :
+        from_index = ("logstash-%4.4d.%2.2d.%2.2d" %
+                      (wh_dt.year, wh_dt.month, wh_dt.day) )
+        to_index   = "%s-%s" % (tp, from_index)
+        pairs.append((from_index, to_index))
+        wh_dt += day_dlt
+
+    # nothing but settled days, no need for a tunnel
+    if all(es_manifest.is_settled(args, tp, from_index, to_index)
+           for (from_index, to_index) in pairs) :
+        es_copy_pool.copy_indices(args, tp, pairs, curl_check_copy, stats)
+        return
+
+    ssh_ctrl_path = "/tmp/%s:%d:%%p" % (tp, floor(random.random()*999999))
+
+    if not open_ssh_tunnel(args, ssh_ctrl_path, tp) :
+        stats.error = "ssh tunnel failed"
+        return
+
+    try:
+        from_inv = es_inventory.get_inventory(args, "http://localhost:%d" %
+                                              ( args.lport ))
+        to_inv   = es_inventory.get_inventory(args, "http://localhost:9200")
+
+        # days that are not in from_inv are reported missing without asking
+        check_copy = lambda a, f, t: curl_check_copy(a, f, t, from_inv, to_inv)
+
+        es_copy_pool.copy_indices(args, tp, pairs, check_copy, stats)
+
+    finally:
+        close_pool("localhost", args.lport)
+        close_ssh_tunnel(args, ssh_ctrl_path, tp)
+
+# end copy_host
+
+
     
 # MAIN MAIN MAIN MAIN MAIN MAIN MAIN MAIN MAIN MAIN MAIN MAIN MAIN MAIN
 
@@ -178,13 +228,19 @@ clparse.add_argument('--tpots', '-t', default="tpot,tpot2,tpot3,tpot4",
                      help='comma delimited list of tpots to copy from')
 clparse.add_argument('--verbose', '-v', action='store_true', default=False,
                      help='verbose output')
-clparse.add_argument('--lport',
+clparse.add_argument('--lport', type=int,
                      default=( floor(64000*random.random()) + 1024 ),
                      help='local port to use for ssh tunnel (random)')
 clparse.add_argument('--rport', default=64298,
                      help='remote port to use for ssh tunnel (64298)')
 clparse.add_argument('--defaults', '-D', action='store_true', default=False,
                      help='show default command line values')
+es_copy_pool.add_pool_args(clparse)
+es_reindex.add_reindex_args(clparse)
+es_repair.add_repair_args(clparse)
+es_manifest.add_manifest_args(clparse)
+es_bulkload.add_bulkload_args(clparse)
+es_stream_copy.add_stream_args(clparse)
 
 args=clparse.parse_args()
 
@@ -224,36 +280,4 @@ if args.verbose :
 
 # start work
 
-for tp in tpots_list :
-    print("\nConnecting to: %s" % str(tp))  # separate tpot output
-    
-    ssh_ctrl_path = "/tmp/%s:%d:%%p" % (tp, floor(random.random()*999999))
-
-    try:
-        if not open_ssh_tunnel(args, ssh_ctrl_path, tp) :
-            continue
-
-        wh_dt = start_dt
-        while wh_dt <= end_dt :
-            from_index = ("logstash-%4.4d.%2.2d.%2.2d" %
-                          (wh_dt.year, wh_dt.month, wh_dt.day) )
-            to_index   = "%s-%s" % (tp, from_index)
-
-            print("%s: %s  to localhost: %s" % ( tp, from_index, to_index ) )
-            sys.stdout.flush()
-
-            try:
-                curl_check_copy(args, from_index, to_index)
-            except BadConnection:
-                print("\nError: failed to connect to %s" % (tp))
-                print("         skipping the rest of coyping for %s\n" % (tp))
-                break
-            
-            wh_dt += day_dlt
-
-        close_ssh_tunnel(args, ssh_ctrl_path, tp)
-
-    except Exception as e:
-        close_ssh_tunnel(args, ssh_ctrl_path, tp)
-        raise e
-
+es_copy_pool.run_hosts(args, tpots_list, copy_host)